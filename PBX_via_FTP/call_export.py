@@ -0,0 +1,108 @@
+"""
+Все права защищены (c) 2024.
+Потоковая выгрузка списка звонков в XLSX, CSV и TSV.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import csv
+
+import openpyxl
+
+from openpyxl.utils import get_column_letter
+
+EXPORT_HEADERS = ["№", "Тип звонка", "Номер", "Аккаунт", "Длит. звонка", "Время"]
+MARK_NAMES = {"green": "Зеленый", "red": "Красный"}
+PROGRESS_STEP = 1000
+
+# Больше строк лист Excel не вмещает
+XLSX_MAX_ROWS = 1048575
+# С такого объема выгрузку предлагается сделать в CSV
+LARGE_EXPORT_ROWS = 100000
+
+
+def call_rows(calls, criteria):
+    """
+    Строки выгрузки по одной на звонок.
+    """
+    for i, call in enumerate(calls, start=1):
+        duration = call["duration"]
+        if call.get("estimated"):
+            duration = f"≈ {duration}"
+        row = [
+            i, call["type"], call["number"], call["account"],
+            duration, call["datetime"]
+        ]
+        marks = call.get("marks", {})
+        for crit in criteria:
+            row.append(MARK_NAMES.get(marks.get(crit, ""), ""))
+        yield row
+
+
+def _report(progress, done, total):
+    if progress is not None and (done % PROGRESS_STEP == 0 or done == total):
+        progress(int(done * 100 / total) if total else 100)
+
+
+def export_xlsx(path, calls, criteria, progress=None, is_running=None):
+    """
+    Выгрузка в XLSX через write-only книгу в два прохода по call_rows: первый
+    считает ширину колонок (в write-only режиме она задается до записи строк),
+    второй пишет строки прямо в лист, не держа их в памяти.
+    Возвращает False, если выгрузка прервана.
+    """
+    is_running = is_running or (lambda: True)
+    headers = EXPORT_HEADERS + list(criteria)
+    widths = [len(h) for h in headers]
+    total = len(calls)
+    for done, row in enumerate(call_rows(calls, criteria), start=1):
+        if not is_running():
+            return False
+        for col, val in enumerate(row):
+            if isinstance(val, str) and len(val) > widths[col]:
+                widths[col] = len(val)
+        # Первая половина прогресса — расчет ширины
+        _report(progress and (lambda p: progress(p // 2)), done, total)
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Звонки")
+    for col, width in enumerate(widths, start=1):
+        ws.column_dimensions[get_column_letter(col)].width = width + 2
+    ws.append(headers)
+    for done, row in enumerate(call_rows(calls, criteria), start=1):
+        if not is_running():
+            return False
+        ws.append(row)
+        _report(progress and (lambda p: progress(50 + p // 2)), done, total)
+    wb.save(path)
+    return True
+
+
+def export_delimited(path, calls, criteria, delimiter=",", progress=None, is_running=None):
+    """
+    Быстрая выгрузка в CSV/TSV (utf-8 с BOM, чтобы Excel правильно открыл кириллицу).
+    """
+    is_running = is_running or (lambda: True)
+    total = len(calls)
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow(EXPORT_HEADERS + list(criteria))
+        for done, row in enumerate(call_rows(calls, criteria), start=1):
+            if not is_running():
+                return False
+            writer.writerow(row)
+            _report(progress, done, total)
+    return True
+
+
+def export_calls(path, calls, criteria, progress=None, is_running=None):
+    """
+    Выбирает формат по расширению файла: .csv, .tsv или .xlsx.
+    """
+    lower = path.lower()
+    if lower.endswith(".csv"):
+        return export_delimited(path, calls, criteria, ",", progress, is_running)
+    if lower.endswith(".tsv"):
+        return export_delimited(path, calls, criteria, "\t", progress, is_running)
+    return export_xlsx(path, calls, criteria, progress, is_running)
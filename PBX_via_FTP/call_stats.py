@@ -0,0 +1,166 @@
+"""
+Все права защищены (c) 2024.
+Сводная статистика звонков по дням и аккаунтам: счетчики по типам, время
+разговоров, гистограмма длительностей и число отметок. Поддерживается
+инкрементально, поэтому таблица дней и панель статистики не перебирают звонки.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import bisect
+
+# Нижние границы корзин гистограммы длительностей, секунды
+HISTOGRAM_EDGES = (0, 1, 10, 30, 60, 180, 600)
+HISTOGRAM_LABELS = ("0 с", "1–9 с", "10–29 с", "30–59 с", "1–3 мин", "3–10 мин", "от 10 мин")
+# Длительность еще не определена (как DURATION_UNKNOWN в call_table)
+UNKNOWN = -1
+
+
+class StatsCell:
+    """
+    Итоги по группе звонков. Пропущенный — входящий с нулевой или еще
+    неизвестной длительностью (как в фильтре «Пропущенный»); среднее время
+    разговора считается по звонкам с длительностью больше нуля.
+    """
+    __slots__ = ("incoming", "outgoing", "missed", "answered", "talk_seconds", "histogram", "marks")
+
+    def __init__(self):
+        self.incoming = 0
+        self.outgoing = 0
+        self.missed = 0
+        self.answered = 0
+        self.talk_seconds = 0
+        self.histogram = [0] * len(HISTOGRAM_EDGES)
+        # {(критерий, цвет): число звонков}
+        self.marks = {}
+
+    @property
+    def total(self):
+        return self.incoming + self.outgoing
+
+    @property
+    def mean_duration(self):
+        return self.talk_seconds / self.answered if self.answered else None
+
+    def count(self, incoming, seconds, sign=1):
+        """
+        Добавляет (sign=1) или убирает (sign=-1) звонок без учета отметок.
+        """
+        if incoming:
+            self.incoming += sign
+            if seconds <= 0:
+                self.missed += sign
+        else:
+            self.outgoing += sign
+        if seconds == UNKNOWN:
+            return
+        if seconds > 0:
+            self.answered += sign
+            self.talk_seconds += sign * seconds
+        self.histogram[bisect.bisect_right(HISTOGRAM_EDGES, seconds) - 1] += sign
+
+    def mark(self, criterion, color, sign=1):
+        key = (criterion, color)
+        value = self.marks.get(key, 0) + sign
+        if value:
+            self.marks[key] = value
+        else:
+            self.marks.pop(key, None)
+
+    def merge(self, other):
+        self.incoming += other.incoming
+        self.outgoing += other.outgoing
+        self.missed += other.missed
+        self.answered += other.answered
+        self.talk_seconds += other.talk_seconds
+        for i, value in enumerate(other.histogram):
+            self.histogram[i] += value
+        for key, value in other.marks.items():
+            self.marks[key] = self.marks.get(key, 0) + value
+
+
+class CallStats:
+    """
+    Материализованные итоги: self.cells — {дата: {аккаунт: StatsCell}},
+    self.days — итоги дня по всем аккаунтам, self.day_keys — отсортированные
+    даты (ISO-строки сортируются как даты). Каждое изменение звонка
+    (добавление, уточнение длительности, отметка) меняет ровно две ячейки.
+    """
+    def __init__(self):
+        self.cells = {}
+        self.days = {}
+        self.day_keys = []
+
+    def _cells_for(self, date_key, account):
+        day = self.days.get(date_key)
+        if day is None:
+            day = self.days[date_key] = StatsCell()
+            self.cells[date_key] = {}
+            bisect.insort(self.day_keys, date_key)
+        by_account = self.cells[date_key]
+        cell = by_account.get(account)
+        if cell is None:
+            cell = by_account[account] = StatsCell()
+        return day, cell
+
+    def add(self, date_key, call, seconds):
+        """
+        Новый звонок; seconds — длительность в секундах или UNKNOWN.
+        """
+        incoming = call["type"] == "Входящий"
+        for cell in self._cells_for(date_key, call["account"]):
+            cell.count(incoming, seconds)
+            for criterion, color in call.get("marks", {}).items():
+                cell.mark(criterion, color)
+
+    def update_duration(self, date_key, call, old_seconds, new_seconds):
+        if old_seconds == new_seconds:
+            return
+        incoming = call["type"] == "Входящий"
+        for cell in self._cells_for(date_key, call["account"]):
+            cell.count(incoming, old_seconds, -1)
+            cell.count(incoming, new_seconds)
+
+    def update_mark(self, date_key, call, criterion, old_color, new_color):
+        if old_color == new_color:
+            return
+        for cell in self._cells_for(date_key, call["account"]):
+            if old_color is not None:
+                cell.mark(criterion, old_color, -1)
+            if new_color is not None:
+                cell.mark(criterion, new_color)
+
+    def day_range(self, start_date=None, end_date=None):
+        """
+        Даты со звонками в периоде (включительно), по возрастанию.
+        """
+        lo = 0 if start_date is None else bisect.bisect_left(self.day_keys, start_date.isoformat())
+        hi = len(self.day_keys) if end_date is None else bisect.bisect_right(self.day_keys, end_date.isoformat())
+        return self.day_keys[lo:hi]
+
+    def summary(self, start_date=None, end_date=None, group_key=None):
+        """
+        Итоги за период, сгруппированные по group_key(дата, аккаунт):
+        {группа: StatsCell}. Без group_key — по аккаунтам.
+        """
+        group_key = group_key or (lambda date_key, account: account)
+        groups = {}
+        for date_key in self.day_range(start_date, end_date):
+            for account, cell in self.cells[date_key].items():
+                key = group_key(date_key, account)
+                target = groups.get(key)
+                if target is None:
+                    target = groups[key] = StatsCell()
+                target.merge(cell)
+        return groups
+
+
+def format_seconds(seconds):
+    """
+    Секунды → "ЧЧ:ММ:СС"; "—" если значения нет.
+    """
+    if seconds is None:
+        return "—"
+    seconds = int(round(seconds))
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
@@ -0,0 +1,376 @@
+"""
+Все права защищены (c) 2024.
+Хранилище звонков, загрузок и отметок FTP-системы АТС на SQLite.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import sqlite3
+import threading
+
+from datetime import datetime
+
+from common import CONFIG_DIR, write_log, save_config
+
+DB_PATH = os.path.join(CONFIG_DIR, "calls.db")
+CALL_COLUMNS = "filename, date, type, number, account, datetime, duration, estimated"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    filename TEXT PRIMARY KEY,
+    local_path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS calls (
+    filename TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    type TEXT NOT NULL,
+    number TEXT NOT NULL,
+    account TEXT NOT NULL,
+    datetime TEXT NOT NULL,
+    duration TEXT NOT NULL,
+    estimated INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_calls_date ON calls(date);
+CREATE INDEX IF NOT EXISTS idx_calls_account ON calls(account);
+CREATE INDEX IF NOT EXISTS idx_calls_number ON calls(number);
+CREATE TABLE IF NOT EXISTS duration_cache (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS marks (
+    filename TEXT NOT NULL,
+    criterion TEXT NOT NULL,
+    color TEXT NOT NULL,
+    PRIMARY KEY (filename, criterion)
+);
+CREATE TABLE IF NOT EXISTS remote_sizes (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS remote_only (
+    filename TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS recording_access (
+    filename TEXT PRIMARY KEY,
+    accessed REAL NOT NULL
+);
+"""
+
+
+def build_call_index(folder_info):
+    """
+    Индекс {имя файла: словарь звонка} для поиска звонка за O(1).
+    """
+    return {
+        call["filename"]: call
+        for folder_data in folder_info.values()
+        for call in folder_data.get("calls", [])
+    }
+
+
+class CallStore:
+    """
+    Индекс звонков в SQLite (режим WAL). Каждый поток получает свое соединение,
+    все изменения записываются небольшими транзакциями.
+    """
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        # Все выданные соединения, чтобы close() закрыл их, а не только свое
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+            # БД, созданные до появления оценок длительности
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(calls)")]
+            if "estimated" not in columns:
+                conn.execute("ALTER TABLE calls ADD COLUMN estimated INTEGER NOT NULL DEFAULT 0")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Соединение используется только своим потоком, но закрывает его close() из любого
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """
+        Закрывает соединения всех потоков. Вызывается, когда рабочие
+        потоки уже остановлены и к хранилищу больше не обращаются.
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local.conn = None
+
+    # -------------------------- Загрузки -------------------------- #
+    def load_downloads(self):
+        rows = self._conn().execute("SELECT filename, local_path FROM downloads")
+        return dict(rows.fetchall())
+
+    def add_download(self, filename, local_path, remote_only=False):
+        """
+        remote_only — запись намеренно не скачана (только список звонков
+        или бюджет кэша) и берется с FTP при обращении. Скачанная запись
+        этот признак снимает.
+        """
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO downloads (filename, local_path) VALUES (?, ?) "
+                "ON CONFLICT(filename) DO UPDATE SET local_path = excluded.local_path",
+                (filename, local_path)
+            )
+            if remote_only:
+                conn.execute("INSERT OR IGNORE INTO remote_only (filename) VALUES (?)", (filename,))
+            else:
+                conn.execute("DELETE FROM remote_only WHERE filename = ?", (filename,))
+
+    def load_remote_only(self):
+        """
+        Записи, которых нет на диске намеренно: не скачанные и вытесненные из кэша.
+        """
+        return {row[0] for row in self._conn().execute("SELECT filename FROM remote_only")}
+
+    def mark_remote_only(self, filenames):
+        with self._conn() as conn:
+            conn.executemany("INSERT OR IGNORE INTO remote_only (filename) VALUES (?)",
+                             [(filename,) for filename in filenames])
+
+    def move_recordings(self, moves):
+        """
+        Записи переложены на диске: moves — список (имя файла, старый путь, новый путь).
+        Обновляются пути загрузок и ключи кэша длительностей (mtime при переносе не меняется).
+        """
+        with self._conn() as conn:
+            conn.executemany(
+                "UPDATE downloads SET local_path = ? WHERE filename = ?",
+                [(new_path, filename) for filename, _, new_path in moves]
+            )
+            conn.executemany(
+                "UPDATE OR REPLACE duration_cache SET path = ? WHERE path = ?",
+                [(new_path, old_path) for _, old_path, new_path in moves]
+            )
+
+    def load_recording_access(self):
+        """
+        Время последнего прослушивания или выгрузки записи: {имя файла: timestamp}.
+        """
+        return dict(self._conn().execute("SELECT filename, accessed FROM recording_access").fetchall())
+
+    def touch_recordings(self, filenames, accessed=None):
+        accessed = accessed or datetime.now().timestamp()
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT INTO recording_access (filename, accessed) VALUES (?, ?) "
+                "ON CONFLICT(filename) DO UPDATE SET accessed = excluded.accessed",
+                [(filename, accessed) for filename in filenames]
+            )
+
+    # -------------------------- Звонки -------------------------- #
+    def load_folder_info(self):
+        """
+        Собирает структуру folder_info ({дата: {day, incoming, outgoing, calls}}) из таблиц.
+        """
+        conn = self._conn()
+        marks = {}
+        for filename, criterion, color in conn.execute("SELECT filename, criterion, color FROM marks"):
+            marks.setdefault(filename, {})[criterion] = color
+
+        folder_info = {}
+        rows = conn.execute(
+            f"SELECT {CALL_COLUMNS} FROM calls ORDER BY rowid"
+        )
+        for filename, call_date, call_type, number, account, call_time, duration, estimated in rows:
+            folder = folder_info.get(call_date)
+            if folder is None:
+                folder = folder_info[call_date] = {
+                    "day": datetime.strptime(call_date, "%Y-%m-%d").strftime("%A"),
+                    "incoming": 0,
+                    "outgoing": 0,
+                    "calls": []
+                }
+            if call_type == "Входящий":
+                folder["incoming"] += 1
+            else:
+                folder["outgoing"] += 1
+            folder["calls"].append({
+                "filename": filename,
+                "type": call_type,
+                "number": number,
+                "account": account,
+                "datetime": call_time,
+                "duration": duration,
+                "estimated": bool(estimated),
+                "marks": marks.get(filename, {})
+            })
+        return folder_info
+
+    def replace_calls(self, folder_info):
+        """
+        Полностью заменяет таблицу calls содержимым folder_info одной транзакцией.
+        """
+        with self._conn() as conn:
+            conn.execute("DELETE FROM calls")
+            conn.executemany(
+                f"INSERT INTO calls ({CALL_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._call_rows(folder_info)
+            )
+
+    def add_calls(self, date_calls):
+        """
+        Добавляет или обновляет звонки; date_calls — список пар (дата папки, звонок).
+        """
+        with self._conn() as conn:
+            conn.executemany(
+                f"INSERT INTO calls ({CALL_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(filename) DO UPDATE SET date = excluded.date, type = excluded.type, "
+                "number = excluded.number, account = excluded.account, "
+                "datetime = excluded.datetime, duration = excluded.duration, "
+                "estimated = excluded.estimated",
+                [self._call_row(date_key, call) for date_key, call in date_calls]
+            )
+
+    def update_durations(self, durations, estimated=False):
+        """
+        durations: список пар (имя файла, длительность). По умолчанию это точные
+        значения, заменяющие оценки по размеру файла.
+        """
+        with self._conn() as conn:
+            conn.executemany(
+                "UPDATE calls SET duration = ?, estimated = ? WHERE filename = ?",
+                [(duration, int(estimated), filename) for filename, duration in durations]
+            )
+
+    def _call_row(self, date_key, call):
+        return (call["filename"], date_key, call["type"], call["number"],
+                call["account"], call["datetime"], call["duration"], int(call.get("estimated", False)))
+
+    def _call_rows(self, folder_info):
+        for date_key, folder_data in folder_info.items():
+            for call in folder_data.get("calls", []):
+                yield self._call_row(date_key, call)
+
+    # -------------------------- Кэш длительностей -------------------------- #
+    def load_duration_cache(self):
+        """
+        Словарь {путь: (mtime, размер, длительность в секундах)}.
+        """
+        rows = self._conn().execute("SELECT path, mtime, size, duration FROM duration_cache")
+        return {path: (mtime, size, duration) for path, mtime, size, duration in rows}
+
+    def save_duration_cache(self, entries):
+        """
+        entries: список (путь, mtime, размер, длительность).
+        """
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO duration_cache (path, mtime, size, duration) VALUES (?, ?, ?, ?)",
+                entries
+            )
+
+    def load_remote_sizes(self, filenames):
+        """
+        Размеры записей на сервере: {имя файла: байты}.
+        """
+        sizes = {}
+        conn = self._conn()
+        filenames = list(filenames)
+        for i in range(0, len(filenames), 500):
+            chunk = filenames[i:i + 500]
+            rows = conn.execute(
+                f"SELECT filename, size FROM remote_sizes WHERE filename IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            sizes.update(rows.fetchall())
+        return sizes
+
+    def save_remote_sizes(self, entries):
+        """
+        entries: список (имя файла, размер на сервере).
+        """
+        with self._conn() as conn:
+            conn.executemany("INSERT OR REPLACE INTO remote_sizes (filename, size) VALUES (?, ?)", entries)
+
+    # -------------------------- Отметки -------------------------- #
+    def load_marks(self, filenames):
+        """
+        Отметки для указанных файлов: {имя файла: {критерий: цвет}}.
+        """
+        marks = {}
+        conn = self._conn()
+        filenames = list(filenames)
+        for i in range(0, len(filenames), 500):
+            chunk = filenames[i:i + 500]
+            rows = conn.execute(
+                f"SELECT filename, criterion, color FROM marks WHERE filename IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for filename, criterion, color in rows:
+                marks.setdefault(filename, {})[criterion] = color
+        return marks
+
+    def set_mark(self, filename, criterion, color):
+        self.set_marks([(filename, criterion, color)])
+
+    def set_marks(self, marks):
+        """
+        Записывает отметки одной транзакцией; marks — список (имя файла, критерий, цвет).
+        """
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT INTO marks (filename, criterion, color) VALUES (?, ?, ?) "
+                "ON CONFLICT(filename, criterion) DO UPDATE SET color = excluded.color",
+                marks
+            )
+
+    # -------------------------- Миграция -------------------------- #
+    def migrate_from_config(self, config):
+        """
+        Однократный перенос downloads, folder_info и отметок из старого config.json.
+        После переноса в JSON остаются только настройки.
+        """
+        downloads = config.get("downloads") or {}
+        folder_info = config.get("folder_info") or {}
+        if not downloads and not folder_info:
+            return False
+
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO downloads (filename, local_path) VALUES (?, ?)",
+                downloads.items()
+            )
+            conn.executemany(
+                f"INSERT OR REPLACE INTO calls ({CALL_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._call_rows(folder_info)
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO marks (filename, criterion, color) VALUES (?, ?, ?)",
+                [
+                    (call["filename"], criterion, color)
+                    for folder_data in folder_info.values()
+                    for call in folder_data.get("calls", [])
+                    for criterion, color in call.get("marks", {}).items()
+                ]
+            )
+        save_config(config)
+        write_log(f"Migrated {len(downloads)} downloads and {len(folder_info)} folders from config.json to SQLite.")
+        return True
+
+    def load_into(self, config):
+        """
+        Подгружает данные индекса в оперативные ключи конфигурации.
+        """
+        config["downloads"] = self.load_downloads()
+        config["folder_info"] = self.load_folder_info()
+        config["call_index"] = build_call_index(config["folder_info"])
@@ -0,0 +1,185 @@
+"""
+Все права защищены (c) 2024.
+Колоночная таблица звонков в памяти и векторная фильтрация на NumPy.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import numpy as np
+
+from datetime import date
+
+from call_stats import CallStats
+from search_index import TrigramIndex, normalize_number
+
+TYPE_CODES = {"Входящий": 0, "Исходящий": 1}
+DURATION_UNKNOWN = -1
+
+
+def duration_to_seconds(duration_str):
+    """
+    "ЧЧ:ММ:СС" → секунды; None для неизвестной длительности.
+    """
+    if not duration_str or duration_str in ("Неизвестно", "Ошибка"):
+        return None
+    parts = duration_str.split(":")
+    if len(parts) == 3:
+        try:
+            h, m, s = map(int, parts)
+            return h * 3600 + m * 60 + s
+        except ValueError:
+            return None
+    return None
+
+
+class CallColumns:
+    """
+    Звонки в виде колонок NumPy: порядковый номер даты, длительность в секундах
+    (с признаком оценки по размеру файла), код типа, идентификаторы номера
+    и аккаунта. Строки отсортированы по дате, поэтому период отбирается
+    срезом через searchsorted. Сами словари звонков лежат
+    в self.calls в том же порядке. Номера и аккаунты хранятся в триграммных
+    индексах, и текстовые фильтры превращаются в маски по их идентификаторам.
+    Фильтры выполняет filter_plan.FilterEngine, а итоги по дням
+    и аккаунтам ведет self.stats (call_stats.CallStats) вместе с колонками.
+    """
+    def __init__(self):
+        self.calls = []
+        self.date_ord = np.empty(0, dtype=np.int32)
+        self.duration = np.empty(0, dtype=np.int32)
+        self.estimated = np.empty(0, dtype=bool)
+        self.type_code = np.empty(0, dtype=np.int8)
+        self.number_id = np.empty(0, dtype=np.int32)
+        self.account_id = np.empty(0, dtype=np.int32)
+        self.numbers = TrigramIndex(normalize=normalize_number)
+        self.accounts = TrigramIndex()
+        self._names = None
+        self._names_accounts = {}
+        self._names_mapping = None
+        self.stats = CallStats()
+        # Растет при любом изменении данных: по нему FilterEngine понимает,
+        # что запомненные результаты устарели
+        self.version = 0
+        self._sorted_durations = None
+
+    def __len__(self):
+        return len(self.calls)
+
+    def load(self, folder_info):
+        """
+        Полная загрузка из folder_info.
+        """
+        version = self.version
+        self.__init__()
+        self.version = version + 1
+        self.extend(
+            (date_key, call)
+            for date_key, folder_data in folder_info.items()
+            for call in folder_data.get("calls", [])
+        )
+
+    def extend(self, date_calls):
+        """
+        Добавляет звонки (дата папки, звонок). Если новые даты не идут после
+        уже загруженных, колонки пересортировываются (сортировка устойчивая).
+        """
+        date_calls = list(date_calls)
+        if not date_calls:
+            return
+        ords = np.fromiter((date.fromisoformat(d).toordinal() for d, _ in date_calls),
+                           dtype=np.int32, count=len(date_calls))
+        durations = np.fromiter((self._duration_value(c) for _, c in date_calls),
+                                dtype=np.int32, count=len(date_calls))
+        estimated = np.fromiter((bool(c.get("estimated")) for _, c in date_calls),
+                                dtype=bool, count=len(date_calls))
+        types = np.fromiter((TYPE_CODES.get(c["type"], 1) for _, c in date_calls),
+                            dtype=np.int8, count=len(date_calls))
+        numbers = np.fromiter((self.numbers.id_for(c["number"]) for _, c in date_calls),
+                              dtype=np.int32, count=len(date_calls))
+        accounts = np.fromiter((self.accounts.id_for(c["account"]) for _, c in date_calls),
+                               dtype=np.int32, count=len(date_calls))
+
+        needs_sort = bool(np.any(np.diff(ords) < 0)) or (
+            len(self.date_ord) > 0 and ords.min() < self.date_ord[-1]
+        )
+        self._changed()
+        for (date_key, call), seconds in zip(date_calls, durations.tolist()):
+            self.stats.add(date_key, call, seconds)
+        self.calls.extend(c for _, c in date_calls)
+        self.date_ord = np.concatenate([self.date_ord, ords])
+        self.duration = np.concatenate([self.duration, durations])
+        self.estimated = np.concatenate([self.estimated, estimated])
+        self.type_code = np.concatenate([self.type_code, types])
+        self.number_id = np.concatenate([self.number_id, numbers])
+        self.account_id = np.concatenate([self.account_id, accounts])
+
+        if needs_sort:
+            order = np.argsort(self.date_ord, kind="stable")
+            self.date_ord = self.date_ord[order]
+            self.duration = self.duration[order]
+            self.estimated = self.estimated[order]
+            self.type_code = self.type_code[order]
+            self.number_id = self.number_id[order]
+            self.account_id = self.account_id[order]
+            self.calls = [self.calls[i] for i in order]
+
+    def refresh_inexact_durations(self):
+        """
+        Перечитывает длительность только у строк, где она была неизвестна или оценена.
+        """
+        rows = np.nonzero((self.duration == DURATION_UNKNOWN) | self.estimated)[0]
+        if len(rows):
+            self._changed()
+        for row in rows:
+            call = self.calls[row]
+            seconds = self._duration_value(call)
+            self.stats.update_duration(date.fromordinal(int(self.date_ord[row])).isoformat(), call,
+                                       int(self.duration[row]), seconds)
+            self.duration[row] = seconds
+            self.estimated[row] = bool(call.get("estimated"))
+
+    def _changed(self):
+        self.version += 1
+        self._sorted_durations = None
+
+    def duration_share_at_least(self, seconds):
+        """
+        Доля звонков с длительностью не меньше seconds (для оценки избирательности).
+        Отсортированная копия длительностей строится один раз на версию данных.
+        """
+        if not len(self.duration):
+            return 0.0
+        if self._sorted_durations is None:
+            self._sorted_durations = np.sort(self.duration)
+        below = np.searchsorted(self._sorted_durations, seconds, side="left")
+        return 1.0 - below / len(self._sorted_durations)
+
+    def _duration_value(self, call):
+        seconds = duration_to_seconds(call.get("duration"))
+        return DURATION_UNKNOWN if seconds is None else seconds
+
+    def number_ids_matching(self, query):
+        return self.numbers.search(query)
+
+    def account_ids_matching(self, query, account_mapping=None):
+        """
+        Аккаунты, содержащие query; с account_mapping — еще и аккаунты,
+        у которых подходит имя сотрудника.
+        """
+        ids = self.accounts.search(query)
+        if not account_mapping:
+            return ids
+        if self._names_mapping != account_mapping:
+            # Индекс имен пересобирается только после изменения соответствий
+            self._names = TrigramIndex()
+            self._names_accounts = {}
+            for acc, name in account_mapping.items():
+                self._names_accounts.setdefault(self._names.id_for(name), []).append(acc)
+            self._names_mapping = dict(account_mapping)
+        by_name = [
+            self.accounts.id_for(acc)
+            for name_id in self._names.search(query)
+            for acc in self._names_accounts[name_id]
+        ]
+        return np.union1d(ids, np.array(by_name, dtype=np.int32))
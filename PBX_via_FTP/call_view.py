@@ -0,0 +1,180 @@
+"""
+Все права защищены (c) 2024.
+Модель и делегаты таблицы звонков: строки не создают виджетов,
+кнопки прослушивания, скачивания и отметок рисуются делегатами.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QEvent, QRect, pyqtSignal
+from PyQt5.QtGui import QColor
+from PyQt5.QtWidgets import QStyledItemDelegate, QStyleOptionButton, QStyle, QApplication
+
+from call_table import duration_to_seconds
+
+BASE_HEADERS = ["№", "Тип", "Номер", "Аккаунт", "Длит.", "Время", "Прослушать", "Скачать"]
+PLAY_COLUMN = 6
+DOWNLOAD_COLUMN = 7
+MARK_COLORS = {"green": QColor(144, 238, 144, 170), "red": QColor(240, 128, 128, 170)}
+
+
+class CallTableModel(QAbstractTableModel):
+    """
+    Модель над списком словарей звонков. Qt запрашивает данные только
+    для видимых строк, поэтому размер списка почти не влияет на скорость.
+    """
+    def __init__(self, criteria, parent=None):
+        super().__init__(parent)
+        self.criteria = list(criteria)
+        self.headers = BASE_HEADERS + self.criteria
+        self.calls = []
+        self.account_mapping = {}
+        self.highlight_threshold = 40
+        self.playing_row = None
+
+    def set_calls(self, calls, account_mapping, highlight_threshold):
+        self.beginResetModel()
+        self.calls = calls
+        self.account_mapping = account_mapping
+        self.highlight_threshold = highlight_threshold
+        self.playing_row = None
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.calls)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, column = index.row(), index.column()
+        call = self.calls[row]
+
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return str(row + 1)
+            if column == 1:
+                return call["type"]
+            if column == 2:
+                # Отображаем подмену по account_mapping
+                return self.account_mapping.get(call["number"], call["number"])
+            if column == 3:
+                return self.account_mapping.get(call["account"], call["account"])
+            if column == 4:
+                if not call["duration"]:
+                    return "Идет загрузка..."
+                # Оценка по размеру файла, пока точная длительность не определена
+                return f"≈ {call['duration']}" if call.get("estimated") else call["duration"]
+            if column == 5:
+                return call["datetime"]
+            if column == PLAY_COLUMN:
+                return "▶"
+            if column == DOWNLOAD_COLUMN:
+                return "Скачать"
+            return None
+
+        if role == Qt.BackgroundRole and column == 0:
+            duration_seconds = duration_to_seconds(call.get("duration", "Неизвестно"))
+            if duration_seconds is not None:
+                if duration_seconds > self.highlight_threshold:
+                    return QColor(Qt.green)
+                elif duration_seconds < 10:
+                    return QColor(Qt.red)
+            return None
+
+        if role == Qt.UserRole:
+            if column == PLAY_COLUMN:
+                return row == self.playing_row
+            if column > DOWNLOAD_COLUMN:
+                return call.setdefault("marks", {}).get(self.criteria[column - len(BASE_HEADERS)])
+        return None
+
+    def criterion_for_column(self, column):
+        return self.criteria[column - len(BASE_HEADERS)]
+
+    def set_playing_row(self, row):
+        previous, self.playing_row = self.playing_row, row
+        for r in (previous, row):
+            if r is not None and 0 <= r < len(self.calls):
+                index = self.index(r, PLAY_COLUMN)
+                self.dataChanged.emit(index, index)
+
+    def refresh_row(self, row):
+        if 0 <= row < len(self.calls):
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.headers) - 1))
+
+    def refresh_rows(self, rows):
+        """
+        Одно обновление на диапазон строк вместо сигнала на каждую строку.
+        """
+        rows = [r for r in rows if 0 <= r < len(self.calls)]
+        if rows:
+            self.dataChanged.emit(self.index(min(rows), 0), self.index(max(rows), len(self.headers) - 1))
+
+    def refresh_durations(self):
+        if self.calls:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self.calls) - 1, 4))
+
+
+class ButtonDelegate(QStyledItemDelegate):
+    """
+    Рисует в ячейке кнопку с текстом ячейки и сообщает о нажатии номером строки.
+    Ячейка с UserRole = True (играющая запись) подсвечивается.
+    """
+    clicked = pyqtSignal(int)
+
+    def paint(self, painter, option, index):
+        button = QStyleOptionButton()
+        button.rect = option.rect.adjusted(1, 1, -1, -1)
+        button.text = index.data(Qt.DisplayRole) or ""
+        button.state = QStyle.State_Enabled
+        QApplication.style().drawControl(QStyle.CE_PushButton, button, painter)
+        if index.data(Qt.UserRole):
+            painter.fillRect(button.rect, MARK_COLORS["green"])
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            self.clicked.emit(index.row())
+            return True
+        return False
+
+
+class MarkDelegate(QStyledItemDelegate):
+    """
+    Две кнопки отметки (зеленая/красная) в одной ячейке критерия.
+    Выбранный цвет подсвечивается фоном кнопки.
+    """
+    marked = pyqtSignal(int, int, str)
+
+    def _halves(self, rect):
+        half = rect.width() // 2
+        left = QRect(rect.left() + 1, rect.top() + 1, half - 2, rect.height() - 2)
+        right = QRect(rect.left() + half + 1, rect.top() + 1, rect.width() - half - 2, rect.height() - 2)
+        return left, right
+
+    def paint(self, painter, option, index):
+        state = index.data(Qt.UserRole)
+        for rect, color, text in zip(self._halves(option.rect), ("green", "red"), ("🟢", "🔴")):
+            button = QStyleOptionButton()
+            button.rect = rect
+            button.text = text
+            button.state = QStyle.State_Enabled
+            QApplication.style().drawControl(QStyle.CE_PushButton, button, painter)
+            if state == color:
+                painter.fillRect(rect, MARK_COLORS[color])
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            left, _ = self._halves(option.rect)
+            color = "green" if event.pos().x() <= left.right() else "red"
+            self.marked.emit(index.row(), index.column(), color)
+            return True
+        return False
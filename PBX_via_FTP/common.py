@@ -0,0 +1,104 @@
+"""
+Все права защищены (c) 2024.
+Общие пути, лог и конфигурация FTP-системы АТС.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import json
+import time
+
+from datetime import datetime
+
+from perf_metrics import span
+from log_writer import get_logger, start_logging, format_fields
+
+# Вне Windows (cron, сервер синхронизации) APPDATA нет — используем ~/.config
+CONFIG_DIR = os.path.join(os.getenv("APPDATA") or os.path.join(os.path.expanduser("~"), ".config"), "ProsluskaZV")
+CONFIG_PATH = os.path.join(CONFIG_DIR, "config.json")
+LOG_PATH = os.path.join(CONFIG_DIR, "app.log")
+# Сводки замеров производительности и файлы для Prometheus
+PERF_DIR = os.path.join(CONFIG_DIR, "perf")
+
+FTP_HOST = "XXX"
+
+# Значения по умолчанию для всех ключей конфигурации
+DEFAULT_CONFIG = {
+    "login": "",
+    "folder_info": {},
+    "downloads": {},
+    "download_path": "Загрузки",
+    "highlight_threshold": 40,
+    "account_mapping": {},
+    "download_workers": 8,
+    "download_limit_kbps": 0,
+    "cache_limit_mb": 0,
+    "metadata_only": False,
+    "poll_interval": 60,
+    "filter_presets": {}
+}
+
+# Ключи, которые живут только в памяти: их данные хранятся в SQLite (call_store.py)
+RUNTIME_KEYS = ("folder_info", "downloads", "call_index")
+
+
+def write_log(message: str, **fields):
+    """
+    Запись сообщения в лог-файл через очередь (log_writer.py), поэтому вызов
+    не ждет диска. fields — структурированные поля (event, file, duration_ms
+    и т.п.), дописываются к строке как key=value.
+    """
+    get_logger(LOG_PATH).info(f"{datetime.now().isoformat()} - {message}{format_fields(fields)}")
+
+
+def use_log_file(name):
+    """
+    Лог процесса пишется в CONFIG_DIR/name; вызывается до первого сообщения.
+    """
+    start_logging(os.path.join(CONFIG_DIR, name))
+
+
+def default_config():
+    """
+    Возвращает новую копию конфигурации по умолчанию.
+    """
+    return json.loads(json.dumps(DEFAULT_CONFIG))
+
+
+def load_config():
+    """
+    Загружает JSON-конфигурацию из CONFIG_PATH.
+    Если файл не найден или поврежден, создает конфиг по умолчанию.
+    """
+    if not os.path.exists(CONFIG_PATH):
+        os.makedirs(CONFIG_DIR, exist_ok=True)
+        write_log("Config not found, creating default config.")
+        return default_config()
+    try:
+        with open(CONFIG_PATH, "r", encoding='utf-8') as f:
+            data = json.load(f)
+        for key, value in default_config().items():
+            if key not in data:
+                data[key] = value
+        return data
+    except json.JSONDecodeError as e:
+        write_log(f"Ошибка чтения конфигурации: {e}")
+        return default_config()
+
+
+def save_config(data):
+    """
+    Сохраняет настройки в файл JSON. Звонки, загрузки и отметки
+    сюда не попадают — они хранятся в SQLite.
+    """
+    settings = {k: v for k, v in data.items() if k not in RUNTIME_KEYS}
+    start = time.perf_counter()
+    try:
+        with span("config.save"), open(CONFIG_PATH, "w", encoding='utf-8') as f:
+            json.dump(settings, f, indent=4, ensure_ascii=False)
+        write_log("Конфигурация сохранена.", event="config_save",
+                  duration_ms=round((time.perf_counter() - start) * 1000, 1))
+    except Exception as e:
+        write_log(f"Ошибка сохранения конфигурации: {e}")
@@ -0,0 +1,179 @@
+"""
+Все права защищены (c) 2024.
+План фильтрации звонков: состояние фильтров собирается в неизменяемый
+FilterPlan, условия применяются от самого избирательного к наименее
+избирательному, а результаты последних планов запоминаются.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import numpy as np
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional
+
+from call_table import TYPE_CODES
+
+# Сколько последних планов хранится вместе с результатами
+PLAN_CACHE_SIZE = 16
+# Априорная доля строк, проходящих условие, если точнее оценить нельзя
+TYPE_SELECTIVITY = 0.5
+MISSED_SELECTIVITY = 0.2
+COLOR_NAMES = {"Зеленый": "green", "Красный": "red"}
+
+
+@dataclass(frozen=True)
+class FilterPlan:
+    """
+    Неизменяемое описание фильтра. Период хранится уже готовыми датами,
+    поэтому план «Текущая неделя», собранный завтра, будет другим.
+    """
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    call_type: Optional[str] = None
+    missed: bool = False
+    min_duration: Optional[int] = None
+    search: str = ""
+    from_number: str = ""
+    to_number: str = ""
+    route: str = ""
+    criterion: Optional[str] = None
+    color: Optional[str] = None
+
+
+def compile_plan(state, period_dates, duration_thresholds):
+    """
+    FilterPlan из состояния фильтров (словарь как у пресета).
+    period_dates(state) → (начало, конец) периода.
+    """
+    call_type = state.get("call_type", "Все")
+    duration = state.get("duration", "Все")
+    min_duration = duration_thresholds.get(duration)
+    if duration == "Другая...":
+        try:
+            min_duration = int(str(state.get("custom_duration", "")).strip())
+        except ValueError:
+            min_duration = None
+    criterion = state.get("criterion")
+    color = COLOR_NAMES.get(state.get("color"))
+    start_date, end_date = period_dates(state)
+    return FilterPlan(
+        start_date=start_date,
+        end_date=end_date,
+        call_type=call_type if call_type in TYPE_CODES else None,
+        missed=call_type == "Пропущенный",
+        min_duration=min_duration,
+        search=state.get("search", "").strip(),
+        from_number=state.get("from_number", "").strip(),
+        to_number=state.get("to_number", "").strip(),
+        route=state.get("route", "").strip(),
+        criterion=criterion if criterion and color else None,
+        color=color if criterion else None
+    )
+
+
+class FilterEngine:
+    """
+    Выполняет планы над CallColumns. Результат плана запоминается и отдается
+    повторно, пока не изменились данные (columns.version), отметки
+    (marks_version) и соответствия аккаунтов.
+    """
+    def __init__(self, columns, cache_size=PLAN_CACHE_SIZE):
+        self.columns = columns
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+
+    def run(self, plan, account_mapping=None, marks_version=0):
+        """
+        Список звонков, прошедших план.
+        """
+        account_mapping = account_mapping or {}
+        key = (plan, self.columns.version, marks_version, tuple(sorted(account_mapping.items())))
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return list(cached)
+
+        calls = self.columns.calls
+        rows = self.select_rows(plan, account_mapping)
+        if plan.criterion is None:
+            result = [calls[row] for row in rows]
+        else:
+            # Отметки не лежат в колонках: проверяются последними, на отобранных строках
+            result = [
+                calls[row] for row in rows
+                if calls[row].setdefault("marks", {}).get(plan.criterion) == plan.color
+            ]
+
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return list(result)
+
+    def select_rows(self, plan, account_mapping):
+        """
+        Номера строк, прошедших колоночные условия. Период отбирается срезом,
+        остальные условия сужают массив номеров строк по очереди, начиная
+        с самого избирательного, так что каждое следующее проверяет меньше строк.
+        """
+        columns = self.columns
+        lo, hi = 0, len(columns)
+        if plan.start_date is not None and plan.end_date is not None:
+            lo = int(np.searchsorted(columns.date_ord, plan.start_date.toordinal(), side="left"))
+            hi = int(np.searchsorted(columns.date_ord, plan.end_date.toordinal(), side="right"))
+            if hi <= lo:
+                return np.empty(0, dtype=np.intp)
+
+        rows = np.arange(lo, hi)
+        for _, predicate in sorted(self._steps(plan, account_mapping), key=lambda step: step[0]):
+            if len(rows) == 0:
+                break
+            rows = rows[predicate(rows)]
+        return rows
+
+    def _steps(self, plan, account_mapping):
+        """
+        Пары (оценка доли проходящих строк, условие над массивом номеров строк).
+        """
+        columns = self.columns
+        steps = []
+        if plan.call_type is not None:
+            code = TYPE_CODES[plan.call_type]
+            steps.append((TYPE_SELECTIVITY, lambda rows: columns.type_code[rows] == code))
+        if plan.missed:
+            incoming = TYPE_CODES["Входящий"]
+            steps.append((MISSED_SELECTIVITY, lambda rows: (columns.type_code[rows] == incoming)
+                          & (columns.duration[rows] <= 0)))
+        # Порог 0 пропускает все звонки, в том числе с еще неизвестной длительностью
+        if plan.min_duration is not None and plan.min_duration > 0:
+            threshold = plan.min_duration
+            steps.append((columns.duration_share_at_least(threshold),
+                          lambda rows: columns.duration[rows] >= threshold))
+
+        number_share = lambda ids: len(ids) / max(1, len(columns.numbers))
+        account_share = lambda ids: len(ids) / max(1, len(columns.accounts))
+        if plan.from_number:
+            number_ids = columns.number_ids_matching(plan.from_number)
+            steps.append((number_share(number_ids), lambda rows: np.isin(columns.number_id[rows], number_ids)))
+        account_ids = None
+        if plan.to_number:
+            account_ids = columns.account_ids_matching(plan.to_number)
+        if plan.route:
+            route_ids = columns.account_ids_matching(plan.route, account_mapping)
+            account_ids = route_ids if account_ids is None else np.intersect1d(account_ids, route_ids)
+        if account_ids is not None:
+            steps.append((account_share(account_ids), lambda rows: np.isin(columns.account_id[rows], account_ids)))
+        if plan.search:
+            any_numbers = columns.number_ids_matching(plan.search)
+            any_accounts = columns.account_ids_matching(plan.search)
+            steps.append((
+                min(1.0, number_share(any_numbers) + account_share(any_accounts)),
+                lambda rows: np.isin(columns.number_id[rows], any_numbers)
+                | np.isin(columns.account_id[rows], any_accounts)
+            ))
+        return steps
@@ -0,0 +1,343 @@
+"""
+Все права защищены (c) 2024.
+Многопоточная загрузка записей звонков с FTP-сервера АТС.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import time
+import queue
+import itertools
+import threading
+
+from ftplib import error_perm
+
+from common import write_log
+from recording_layout import recording_path
+from ftp_session import FTPSession, SessionLost, backoff_delay
+
+DEFAULT_WORKERS = 8
+MAX_WORKERS = 16
+PART_SUFFIX = ".part"
+# Файл, не скачанный за одну сессию, уходит в очередь повторов; столько раз максимум
+FILE_RETRIES = 3
+RETRY_DELAY = 5.0
+
+# Подстройка числа сессий: оценка идет окнами не короче ADJUST_SECONDS
+# и не меньше чем по ADJUST_TRANSFERS скачанных файлов
+ADJUST_SECONDS = 3.0
+ADJUST_TRANSFERS = 4
+# Прирост скорости, ради которого стоит добавить сессию, и падение, после которого их число сокращается вдвое
+GAIN_THRESHOLD = 0.05
+DROP_THRESHOLD = 0.25
+
+
+def remote_size(ftp, path):
+    """
+    Размер файла на сервере (команда SIZE) или None, если сервер его не сообщает.
+    """
+    try:
+        ftp.voidcmd("TYPE I")
+        return ftp.size(path)
+    except error_perm:
+        return None
+
+
+class RateLimiter:
+    """
+    Общее для всех сессий ограничение скорости (token bucket), байт в секунду.
+    0 — без ограничения.
+    """
+    def __init__(self, bytes_per_second=0):
+        self.rate = bytes_per_second
+        self.lock = threading.Lock()
+        self.allowance = bytes_per_second
+        self.last = time.monotonic()
+
+    def consume(self, nbytes):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= nbytes
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        # Долг уже списан, поэтому следующие потоки подождут дольше
+        if delay:
+            time.sleep(delay)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD-регулятор числа одновременных передач. По окнам из нескольких файлов
+    считается общая скорость и число ошибок: если новая сессия дала прирост
+    скорости, лимит растет на одну; ошибки или заметное падение скорости
+    сокращают лимит вдвое.
+    """
+    def __init__(self, maximum, initial=None, minimum=1):
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        self.limit = max(minimum, min(initial or self.maximum, self.maximum))
+        self.active = 0
+        self.cond = threading.Condition()
+        self.prev_rate = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_done = 0
+        self.window_errors = 0
+
+    def acquire(self, is_running):
+        """
+        Ждет свободного места под передачу. False — загрузка отменена.
+        """
+        with self.cond:
+            while self.active >= self.limit:
+                if not is_running():
+                    return False
+                self.cond.wait(0.2)
+            self.active += 1
+            return True
+
+    def cancel(self):
+        """
+        Место освобождается без передачи (задание еще не готово к повтору).
+        """
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def release(self, nbytes, failed):
+        with self.cond:
+            self.active -= 1
+            self.window_bytes += nbytes
+            self.window_done += 1
+            self.window_errors += int(failed)
+            elapsed = time.monotonic() - self.window_start
+            if self.window_done >= max(ADJUST_TRANSFERS, self.limit) and elapsed >= ADJUST_SECONDS:
+                self._adjust(self.window_bytes / elapsed)
+            self.cond.notify_all()
+
+    def saturated(self):
+        """
+        Все места заняты: освободившаяся сессия будет ждать и может закрыть соединение.
+        """
+        with self.cond:
+            return self.active >= self.limit
+
+    def _adjust(self, rate):
+        old_limit = self.limit
+        if self.window_errors:
+            self.limit = max(self.minimum, self.limit // 2)
+        elif self.prev_rate is not None and rate < self.prev_rate * (1 - DROP_THRESHOLD):
+            self.limit = max(self.minimum, self.limit // 2)
+        elif self.prev_rate is None or rate > self.prev_rate * (1 + GAIN_THRESHOLD):
+            self.limit = min(self.maximum, self.limit + 1)
+        if self.limit != old_limit:
+            write_log(f"Download sessions {old_limit} -> {self.limit}: "
+                      f"{rate / 1024:.0f} KB/s, {self.window_errors} errors in {self.window_done} transfers")
+        self.prev_rate = rate
+        self._reset_window()
+
+
+def fetch_file(ftp, file, local_path, size=None, limiter=None):
+    """
+    Скачивает файл текущей папки во временный .part, докачивая его с места
+    обрыва через REST, и атомарно переименовывает после сверки размера с SIZE.
+    Возвращает число байт, полученных за этот вызов.
+    """
+    part_path = local_path + PART_SUFFIX
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    if size is None:
+        size = remote_size(ftp, file)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if size is not None and offset > size:
+        offset = 0
+    with open(part_path, "ab" if offset else "wb") as f_local:
+        if limiter is None:
+            callback = f_local.write
+        else:
+            def callback(data):
+                limiter.consume(len(data))
+                f_local.write(data)
+        ftp.retrbinary(f"RETR {file}", callback, rest=offset or None)
+
+    actual = os.path.getsize(part_path)
+    if size is not None and actual != size:
+        if actual > size:
+            os.remove(part_path)
+        raise IOError(f"size mismatch for {file}: {actual} of {size} bytes")
+    os.replace(part_path, local_path)
+    return actual - offset
+
+
+def find_truncated_files(ftp, listing, folders, local_files):
+    """
+    Проверка уже скачанных записей: локальный размер сверяется с размером на сервере.
+    local_files — результат scan_recordings ({имя: (путь, размер, mtime)}); сломанные
+    записи из него убираются. Усеченный файл переименовывается в .part, чтобы его
+    докачали с места обрыва, а файл больше оригинала удаляется.
+    Возвращает список (папка, файл) для загрузки.
+    """
+    broken = []
+    for folder in folders:
+        if listing.is_verified(folder):
+            continue
+        for file, info in listing.files(folder).items():
+            local = local_files.get(file)
+            if local is None:
+                continue
+            if info.get("size") is None:
+                info["size"] = remote_size(ftp, f"/recordings/{folder}/{file}")
+            if info["size"] is None:
+                continue
+            local_path, local_size, _ = local
+            if local_size == info["size"]:
+                continue
+            del local_files[file]
+            if local_size < info["size"]:
+                os.replace(local_path, local_path + PART_SUFFIX)
+            else:
+                os.remove(local_path)
+            write_log(f"Truncated file found: {file} ({local_size} of {info['size']} bytes)")
+            listing.mark_incomplete(folder)
+            broken.append((folder, file))
+        listing.mark_verified(folder)
+    return broken
+
+
+class ParallelDownloader:
+    """
+    Пул FTP-сессий. Каждая сессия живет в своем потоке и забирает задания
+    (папка, файл) из общей очереди. workers — верхняя граница: сколько сессий
+    реально качают одновременно, решает AdaptiveConcurrency, а общую скорость
+    при необходимости ограничивает RateLimiter. Файл, который не удалось
+    скачать даже с переподключениями, возвращается в очередь с растущей
+    паузой, а остальные файлы папки тем временем продолжают качаться.
+    """
+    def __init__(self, host, user, passwd, target_dir, workers=DEFAULT_WORKERS, is_running=None,
+                 limiter=None):
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+        self.target_dir = target_dir
+        self.workers = max(1, min(int(workers), MAX_WORKERS))
+        self.is_running = is_running or (lambda: True)
+        self.limiter = limiter
+        self.controller = AdaptiveConcurrency(self.workers, initial=max(1, self.workers // 2))
+        # (время готовности, порядковый номер, задание, номер повтора)
+        self.tasks = queue.PriorityQueue()
+        self.results = queue.Queue()
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.outstanding = 0
+
+    def download(self, items):
+        """
+        Скачивает список (папка, файл, размер) и по мере готовности отдает кортежи
+        (папка, файл, локальный путь, ошибка). Генератор выполняется в потоке
+        вызывающего, поэтому обработку результатов не нужно синхронизировать.
+        """
+        items = list(items)
+        if not items:
+            return
+        self.outstanding = len(items)
+        for item in items:
+            self.tasks.put((0.0, next(self.order), item, 0))
+
+        threads = [
+            threading.Thread(target=self._worker, name=f"ftp-worker-{i}", daemon=True)
+            for i in range(min(self.workers, len(items)))
+        ]
+        for t in threads:
+            t.start()
+
+        done = 0
+        while done < len(items):
+            try:
+                result = self.results.get(timeout=0.2)
+            except queue.Empty:
+                # Все сессии завершились (отмена или сервер недоступен) — ждать больше нечего
+                if not any(t.is_alive() for t in threads) and self.results.empty():
+                    break
+                continue
+            done += 1
+            yield result
+
+        for t in threads:
+            t.join()
+
+    def _finish(self, folder, file, local_path, error):
+        with self.lock:
+            self.outstanding -= 1
+        self.results.put((folder, file, local_path, error))
+
+    def _next_task(self):
+        """
+        Готовое к скачиванию задание или None, если заданий больше не будет.
+        """
+        while self.is_running():
+            with self.lock:
+                if self.outstanding <= 0:
+                    return None
+            try:
+                ready_at, order, item, retry = self.tasks.get(timeout=0.2)
+            except queue.Empty:
+                # Все оставшиеся задания сейчас у других сессий
+                continue
+            wait = ready_at - time.monotonic()
+            if wait > 0:
+                self.tasks.put((ready_at, order, item, retry))
+                time.sleep(min(wait, 0.2))
+                continue
+            return item, retry
+        return None
+
+    def _worker(self):
+        session = FTPSession(self.host, self.user, self.passwd, is_running=self.is_running)
+        try:
+            while self.is_running():
+                if session.ftp is not None and self.controller.saturated():
+                    # Лимит сессий снижен: пока ждем, соединение серверу не нужно
+                    session.close()
+                if not self.controller.acquire(self.is_running):
+                    break
+                task = self._next_task()
+                if task is None:
+                    self.controller.cancel()
+                    break
+                (folder, file, size), retry = task
+                local_path = recording_path(self.target_dir, file)
+                received = [0]
+                failures = session.failures
+
+                def transfer(ftp):
+                    received[0] += fetch_file(ftp, file, local_path, size, self.limiter)
+
+                try:
+                    session.run(transfer, folder=folder)
+                except SessionLost as e:
+                    # Сервер недоступен: задание остается другим сессиям, эта завершается
+                    write_log(f"FTP worker connection error: {e}")
+                    self.tasks.put((time.monotonic() + RETRY_DELAY, next(self.order), (folder, file, size), retry))
+                    self.controller.release(received[0], True)
+                    return
+                except Exception as e:
+                    self.controller.release(received[0], True)
+                    if isinstance(e, error_perm) or retry >= FILE_RETRIES or not self.is_running():
+                        self._finish(folder, file, None, e)
+                    else:
+                        delay = backoff_delay(retry + 1, RETRY_DELAY)
+                        write_log(f"Transfer of {file} failed ({e}), queued for retry in {delay:.0f}s")
+                        self.tasks.put((time.monotonic() + delay, next(self.order), (folder, file, size), retry + 1))
+                    continue
+                # Докачка после обрыва тоже признак перегрузки сервера
+                self.controller.release(received[0], session.failures > failures)
+                self._finish(folder, file, local_path, None)
+        finally:
+            session.close()
@@ -0,0 +1,129 @@
+"""
+Все права защищены (c) 2024.
+FTP-сессия с keepalive, переподключением и повтором операций с растущей паузой.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import time
+import random
+
+from ftplib import FTP, all_errors, error_perm
+
+from common import write_log
+
+# Сколько раз операция повторяется в одной сессии (с переподключением между попытками)
+SESSION_ATTEMPTS = 3
+# Простаивающая дольше сессия перед использованием проверяется командой NOOP
+KEEPALIVE_SECONDS = 30
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+
+class SessionLost(Exception):
+    """
+    Сервер недоступен: не удалось даже переподключиться.
+    """
+
+
+def connect_ftp(host, user, passwd):
+    """
+    Открывает FTP-сессию в пассивном режиме и выполняет вход.
+    """
+    ftp = FTP(host)
+    ftp.set_pasv(True)
+    ftp.login(user, passwd)
+    return ftp
+
+
+def close_ftp(ftp):
+    try:
+        ftp.quit()
+    except Exception:
+        ftp.close()
+
+
+def backoff_delay(attempt, base=None):
+    """
+    Пауза перед повтором номер attempt (с 1): удваивается с каждой попыткой,
+    ограничена BACKOFF_MAX и слегка размыта, чтобы сессии не переподключались хором.
+    """
+    base = BACKOFF_BASE if base is None else base
+    return min(BACKOFF_MAX, base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+class FTPSession:
+    """
+    Обертка над ftplib.FTP. Соединение открывается при первой операции,
+    простаивавшее соединение проверяется NOOP, а операция, оборванная
+    сетевой ошибкой, повторяется после переподключения и повторного входа.
+    Ошибки 5xx (нет файла, нет прав) не повторяются.
+    """
+    def __init__(self, host, user, passwd, attempts=SESSION_ATTEMPTS, is_running=None):
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+        self.attempts = attempts
+        self.is_running = is_running or (lambda: True)
+        self.ftp = None
+        self.folder = None
+        self.last_used = 0.0
+        # Сколько раз операции обрывались; по приросту видно, что был повтор
+        self.failures = 0
+
+    def close(self):
+        if self.ftp is not None:
+            close_ftp(self.ftp)
+        self.ftp = None
+        self.folder = None
+
+    def keepalive(self):
+        """
+        NOOP для простаивающего соединения; мертвое соединение закрывается,
+        и следующая операция откроет новое.
+        """
+        if self.ftp is None or time.monotonic() - self.last_used < KEEPALIVE_SECONDS:
+            return
+        try:
+            self.ftp.voidcmd("NOOP")
+            self.last_used = time.monotonic()
+        except all_errors as e:
+            write_log(f"FTP keepalive failed ({e}), session will reconnect")
+            self.close()
+
+    def run(self, action, folder=None):
+        """
+        Выполняет action(ftp), при необходимости перейдя в /recordings/folder.
+        Возвращает результат action или бросает последнюю ошибку;
+        SessionLost — если не удалось подключиться.
+        """
+        for attempt in range(1, self.attempts + 1):
+            try:
+                self.keepalive()
+                if self.ftp is None:
+                    try:
+                        self.ftp = connect_ftp(self.host, self.user, self.passwd)
+                    except all_errors as e:
+                        raise SessionLost(e) from e
+                if folder is not None and folder != self.folder:
+                    self.ftp.cwd(f"/recordings/{folder}")
+                    self.folder = folder
+                result = action(self.ftp)
+                self.last_used = time.monotonic()
+                return result
+            except error_perm:
+                raise
+            except (SessionLost, *all_errors) as e:
+                self.failures += 1
+                self.close()
+                if attempt == self.attempts or not self.is_running():
+                    raise
+                delay = backoff_delay(attempt)
+                write_log(f"FTP operation failed ({e}), retry {attempt} in {delay:.1f}s")
+                self._sleep(delay)
+
+    def _sleep(self, delay):
+        end = time.monotonic() + delay
+        while self.is_running() and time.monotonic() < end:
+            time.sleep(min(0.2, end - time.monotonic()))
@@ -0,0 +1,92 @@
+"""
+Все права защищены (c) 2024.
+Фоновая запись лога на стандартном logging: сообщения уходят в очередь
+(QueueHandler), а в файл их пишет QueueListener через RotatingFileHandler.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import queue
+import atexit
+import logging
+import threading
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Размер, после которого app.log переименовывается в app.log.1, и число хранимых копий
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+
+_logger = logging.getLogger("pbx_via_ftp")
+_logger.setLevel(logging.INFO)
+_logger.propagate = False
+_listener = None
+_path = None
+_lock = threading.Lock()
+
+
+def format_fields(fields):
+    """
+    Структурированные поля в виде " | event=download file=x.mp3 duration_ms=12".
+    """
+    if not fields:
+        return ""
+    return " | " + " ".join(f"{key}={value}" for key, value in fields.items() if value is not None)
+
+
+def start_logging(path):
+    """
+    Направляет лог процесса в path. Файл ротирует только этот процесс,
+    поэтому у GUI и pbx_sync файлы разные. Повторный вызов с другим
+    путем дописывает очередь в старый файл и переключается на новый.
+    """
+    global _listener, _path
+    with _lock:
+        if _listener is not None:
+            if path == _path:
+                return
+            _stop_locked()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_handler = RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS,
+                                           encoding="utf-8", delay=True)
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        log_queue = queue.SimpleQueue()
+        _logger.addHandler(QueueHandler(log_queue))
+        _listener = QueueListener(log_queue, file_handler)
+        _listener.start()
+        _path = path
+
+
+def stop_logging():
+    """
+    Дописывает очередь и закрывает файл (вызывается и при выходе из программы).
+    """
+    with _lock:
+        _stop_locked()
+
+
+def _stop_locked():
+    global _listener, _path
+    if _listener is None:
+        return
+    for handler in list(_logger.handlers):
+        _logger.removeHandler(handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+    _path = None
+
+
+def get_logger(path):
+    """
+    Логгер процесса; при первом сообщении запускается запись в path.
+    """
+    if _listener is None:
+        start_logging(path)
+    return _logger
+
+
+atexit.register(stop_logging)
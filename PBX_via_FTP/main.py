@@ -9,16 +9,14 @@
 import os
 import sys
 import re
-import json
 import ctypes
+import queue
+import threading
+import itertools
 import tempfile
-import openpyxl
 import qdarkstyle
 
 from datetime import datetime, timedelta, date
-from ftplib import FTP
-from pydub import AudioSegment
-from openpyxl.styles import Alignment
 from PyQt5.QtGui import QMovie
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer, QUrl, QDate, QObject
@@ -26,9 +24,38 @@ from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QVBoxLayout, QWidget, QPushButton, QTableWidget,
     QTableWidgetItem, QLabel, QLineEdit, QDialog, QDialogButtonBox, QProgressDialog,
     QComboBox, QSlider, QMessageBox, QToolBar, QAction, QFileDialog, QInputDialog,
-    QHBoxLayout, QDateEdit, QFormLayout, QHeaderView
+    QHBoxLayout, QDateEdit, QFormLayout, QHeaderView, QTableView, QProgressBar, QMenu
 )
 
+from common import CONFIG_DIR, FTP_HOST, PERF_DIR, write_log, load_config, save_config
+from ftp_download import DEFAULT_WORKERS, MAX_WORKERS
+from call_store import CallStore
+from call_table import CallColumns
+from filter_plan import FilterEngine, compile_plan
+from call_stats import HISTOGRAM_LABELS, StatsCell, format_seconds
+from call_view import CallTableModel, ButtonDelegate, MarkDelegate, BASE_HEADERS, PLAY_COLUMN, DOWNLOAD_COLUMN
+from sync_core import (
+    download_recordings, rebuild_calls, load_durations, index_calls, ingest_files, RecentPoller,
+    migrate_recording_layout
+)
+from call_export import export_calls, XLSX_MAX_ROWS, LARGE_EXPORT_ROWS
+from recording_cache import RecordingCache, enforce_budget, PREFETCH_ROWS
+from perf_metrics import metrics, span, timed, write_summary, write_prometheus
+
+# Периоды фильтра и панели статистики
+PERIODS = ["Все", "Сегодня", "Вчера", "Текущая неделя", "Прошлая неделя",
+           "Текущий месяц", "Прошлый месяц", "Произвольный период"]
+
+# Пороги фильтра «Длит.» в секундах
+DURATION_THRESHOLDS = {
+    "От 5 секунд": 5,
+    "От 10 секунд": 10,
+    "От 20 секунд": 20,
+    "От 30 секунд": 30,
+    "От 40 секунд": 40,
+    "От 60 секунд (1 мин)": 60
+}
+
 # Критерии, по которым аналитики делают отметки
 CRITERIA = [
     "XXX",
@@ -36,168 +63,49 @@ CRITERIA = [
     "ZZZ"
 ]
 
-CONFIG_DIR = os.path.join(os.getenv("APPDATA"), "ProsluskaZV")
-CONFIG_PATH = os.path.join(CONFIG_DIR, "config.json")
-LOG_PATH = os.path.join(CONFIG_DIR, "app.log")
+# Отметки копятся в памяти и пишутся в БД одной транзакцией после паузы в кликах
+MARK_FLUSH_MS = 2000
 
 tempfile.tempdir = os.path.join(CONFIG_DIR, "Temp")
 os.makedirs(tempfile.tempdir, exist_ok=True)
 
-def write_log(message: str):
-    """
-    Запись текстового сообщения в лог-файл.
-    """
-    os.makedirs(CONFIG_DIR, exist_ok=True)
-    with open(LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(f"{datetime.now().isoformat()} - {message}\n")
-
-
-def load_config():
-    """
-    Загружает JSON-конфигурацию из CONFIG_PATH.
-    Если файл не найден или поврежден, создает конфиг по умолчанию.
-    """
-    if not os.path.exists(CONFIG_PATH):
-        os.makedirs(CONFIG_DIR, exist_ok=True)
-        write_log("Config not found, creating default config.")
-        return {
-            "login": "",
-            "folder_info": {},
-            "downloads": {},
-            "download_path": "Загрузки",
-            "highlight_threshold": 40,
-            "account_mapping": {}
-        }
-    try:
-        with open(CONFIG_PATH, "r", encoding='utf-8') as f:
-            data = json.load(f)
-        if "download_path" not in data:
-            data["download_path"] = "Загрузки"
-        if "highlight_threshold" not in data:
-            data["highlight_threshold"] = 40
-        if "account_mapping" not in data:
-            data["account_mapping"] = {}
-        return data
-    except json.JSONDecodeError as e:
-        write_log(f"Ошибка чтения конфигурации: {e}")
-        return {
-            "login": "",
-            "folder_info": {},
-            "downloads": {},
-            "download_path": "Загрузки",
-            "highlight_threshold": 40,
-            "account_mapping": {}
-        }
-
-
-def save_config(data):
-    """
-    Сохраняет текущую конфигурацию в файл JSON.
-    """
-    try:
-        with open(CONFIG_PATH, "w", encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-        write_log("Конфигурация сохранена.")
-    except Exception as e:
-        write_log(f"Ошибка сохранения конфигурации: {e}")
-
 
 class DownloadThread(QThread):
     """
     Фоновый поток для скачивания файлов (записей звонков) с FTP-сервера.
+    Свежие дни качаются первыми; звонки каждой докачанной папки сразу
+    передаются в GUI сигналом new_calls, не дожидаясь конца загрузки.
     """
     progress = pyqtSignal(int)
     status = pyqtSignal(str)
+    new_calls = pyqtSignal(object, object)
+    priority_done = pyqtSignal()
     finished = pyqtSignal()
 
-    def __init__(self, config, host, user, passwd, days_to_download=360, parent=None):
+    def __init__(self, config, store, host, user, passwd, days_to_download=360, parent=None, keep=None):
         super().__init__(parent)
         self.config = config
+        self.store = store
         self.host = host
         self.user = user
         self.passwd = passwd
         self.days_to_download = days_to_download
+        # keep() — записи, которые чистка кэша не трогает (играющая и подкачиваемые)
+        self.keep = keep or set
         self.running = True
 
     def run(self):
-        write_log("Starting download thread.")
-        try:
-            ftp = FTP(self.host)
-            ftp.set_pasv(True)
-            ftp.login(self.user, self.passwd)
-            self.status.emit("Подключение к FTP выполнено.")
-            write_log("Connected to FTP.")
-        except Exception as e:
-            self.status.emit(f"Ошибка подключения к FTP: {e}")
-            write_log(f"FTP connection error: {e}")
-            self.finished.emit()
-            return
-
-        target_date = datetime.now() - timedelta(days=self.days_to_download)
-        try:
-            ftp.cwd("/recordings")
-            folders = ftp.nlst()
-        except Exception as e:
-            self.status.emit(f"Ошибка получения списка папок: {e}")
-            write_log(f"Error getting folder list: {e}")
-            ftp.quit()
-            self.finished.emit()
-            return
-
-        # Фильтрация папок по дате
-        folders_to_download = [
-            f for f in folders
-            if self.is_date_format(f) and f >= target_date.strftime("%Y-%m-%d")
-        ]
-
-        zvonki_dir = os.path.join(CONFIG_DIR, "Zvonki")
-        os.makedirs(zvonki_dir, exist_ok=True)
-
-        total_files = 0
-        files_downloaded = 0
-        for folder in folders_to_download:
-            try:
-                folder_files = ftp.nlst(f"/recordings/{folder}")
-                folder_files = [f for f in folder_files if f.endswith('.mp3')]
-                total_files += len(folder_files)
-            except Exception as e:
-                write_log(f"Error accessing folder {folder}: {e}")
-
-        for folder in folders_to_download:
-            if not self.running:
-                break
-            try:
-                ftp.cwd(f"/recordings/{folder}")
-                files = ftp.nlst()
-                files = [f for f in files if f.endswith('.mp3')]
-                for file in files:
-                    if not self.running:
-                        break
-                    local_path = os.path.join(zvonki_dir, file)
-                    if not os.path.exists(local_path):
-                        with open(local_path, 'wb') as f_local:
-                            ftp.retrbinary(f"RETR {file}", f_local.write)
-                        self.config["downloads"][file] = local_path
-                        save_config(self.config)
-                        write_log(f"Downloaded file: {file}")
-                    files_downloaded += 1
-                    progress = int((files_downloaded / total_files) * 100)
-                    self.progress.emit(progress)
-                    self.status.emit(f"Загружено {files_downloaded} из {total_files} файлов")
-            except Exception as e:
-                write_log(f"File download error: {e}")
-
-        ftp.quit()
-        self.status.emit("Загрузка завершена.")
-        write_log("Download finished.")
+        download_recordings(
+            self.config, self.store, self.host, self.user, self.passwd, self.days_to_download,
+            is_running=lambda: self.running, progress=self.progress.emit, status=self.status.emit,
+            publish=self.publish, on_priority_done=self.priority_done.emit
+        )
+        # Кэш приводится к бюджету один раз, после всей загрузки (как в pbx_sync)
+        enforce_budget(self.store, self.config.get("cache_limit_mb", 0) * 1024 * 1024, keep=self.keep())
         self.finished.emit()
 
-    def is_date_format(self, folder_name):
-        try:
-            datetime.strptime(folder_name, "%Y-%m-%d")
-            return True
-        except ValueError:
-            return False
+    def publish(self, files):
+        self.new_calls.emit(files, ingest_files(self.store, files))
 
 
 class DurationLoaderThread(QThread):
@@ -207,44 +115,152 @@ class DurationLoaderThread(QThread):
     """
     updated = pyqtSignal()
 
-    def __init__(self, config):
+    def __init__(self, config, store):
         super().__init__()
         self.config = config
+        self.store = store
         self.running = True
 
     def run(self):
         write_log("Starting duration loader thread.")
-        changed = False
-        for date_key, folder_data in self.config.get("folder_info", {}).items():
-            calls = folder_data.get("calls", [])
-            for call in calls:
-                if not self.running:
-                    break
-                if call["duration"] in ("Неизвестно", "Ошибка"):
-                    filename = call["filename"]
-                    local_path = self.config["downloads"].get(filename)
-                    if local_path and os.path.exists(local_path):
-                        try:
-                            audio = AudioSegment.from_file(local_path, format="mp3")
-                            duration_seconds = len(audio) / 1000.0
-                            duration_str = self.format_duration(duration_seconds)
-                            call["duration"] = duration_str
-                            changed = True
-                            write_log(f"Duration updated for {filename}: {duration_str}")
-                        except Exception as e:
-                            write_log(f"Error getting duration for {filename}: {e}")
-                            call["duration"] = "Неизвестно"
-            if changed:
-                save_config(self.config)
-                changed = False
-                self.updated.emit()
-
-    def format_duration(self, seconds):
-        seconds = int(seconds)
-        h = seconds // 3600
-        m = (seconds % 3600) // 60
-        s = seconds % 60
-        return f"{h:02d}:{m:02d}:{s:02d}"
+        load_durations(self.config, self.store, is_running=lambda: self.running, on_batch=self.updated.emit)
+
+
+class WatchThread(QThread):
+    """
+    Фоновый опрос папки текущего дня: новые записи скачиваются и передаются
+    в GUI сигналом new_calls. folder_info изменяется только в потоке GUI.
+    Период опроса берется из config["poll_interval"] (0 — опрос выключен).
+    """
+    new_calls = pyqtSignal(object, object)
+
+    def __init__(self, config, store, host, user, passwd):
+        super().__init__()
+        self.config = config
+        self.poller = RecentPoller(store, host, user, passwd, known=config.get("call_index", {}),
+                                   metadata_only=config.get("metadata_only", False))
+        self.running = True
+
+    def run(self):
+        write_log("Starting watch thread.")
+        waited = 0
+        while self.running:
+            self.msleep(500)
+            waited += 500
+            interval = self.config.get("poll_interval", 60)
+            if interval <= 0 or waited < interval * 1000:
+                # Между опросами соединение поддерживается NOOP
+                self.poller.keepalive()
+                continue
+            waited = 0
+            fetched, date_calls = self.poller.poll(is_running=lambda: self.running)
+            if fetched:
+                self.new_calls.emit(fetched, date_calls)
+        self.poller.close()
+
+
+class FetchThread(QThread):
+    """
+    Фоновое получение записей, которых нет в кэше. Запрос на прослушивание
+    или сохранение идет вне очереди, подкачка соседних строк — после него.
+    Когда очередь пустеет, кэш приводится к заданному размеру; играющая запись
+    (keep) и записи, еще стоящие в очереди, при этом не удаляются.
+    У скачанной записи оценка длительности сразу заменяется точным значением.
+    """
+    fetched = pyqtSignal(str, str, str)
+    durations_updated = pyqtSignal()
+
+    def __init__(self, config, store, host, user, passwd):
+        super().__init__()
+        self.config = config
+        self.store = store
+        self.cache = RecordingCache(store, host, user, passwd)
+        self.requests = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.keep = set()
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.running = True
+
+    def request(self, filename, urgent=False):
+        with self.lock:
+            self.queued.add(filename)
+        self.requests.put((0 if urgent else 1, next(self.order), filename))
+
+    def protected(self):
+        """
+        Записи, которые чистка кэша не должна трогать: играющая и ожидающие загрузки.
+        Вызывается из любого потока.
+        """
+        with self.lock:
+            return set(self.keep) | self.queued
+
+    def run(self):
+        write_log("Starting fetch thread.")
+        fetched_any = False
+        while self.running:
+            try:
+                _, _, filename = self.requests.get(timeout=0.5)
+            except queue.Empty:
+                if fetched_any:
+                    enforce_budget(self.store, self.config.get("cache_limit_mb", 0) * 1024 * 1024,
+                                   keep=self.protected())
+                    fetched_any = False
+                self.cache.keepalive()
+                continue
+            try:
+                existed = os.path.exists(self.cache.local_path(filename))
+                path, error = self.cache.fetch(filename), ""
+                fetched_any = fetched_any or not existed
+            except Exception as e:
+                write_log(f"Fetching {filename} failed: {e}")
+                path, error = "", str(e)
+            with self.lock:
+                self.queued.discard(filename)
+            self.fetched.emit(filename, path, error)
+            if path and not existed:
+                load_durations(self.config, self.store, only=[filename], on_batch=self.durations_updated.emit)
+        self.cache.close()
+
+
+class ExportThread(QThread):
+    """
+    Фоновая выгрузка звонков в файл, чтобы окно не замирало на больших выборках.
+    """
+    progress = pyqtSignal(int)
+    done = pyqtSignal(bool, str)
+
+    def __init__(self, filename, calls, criteria, store):
+        super().__init__()
+        self.store = store
+        self.filename = filename
+        self.calls = calls
+        self.criteria = criteria
+        self.running = True
+
+    def run(self):
+        write_log(f"Export of {len(self.calls)} calls to {self.filename} started.")
+        # Выгруженные записи считаются использованными и дольше живут в кэше
+        self.store.touch_recordings(call["filename"] for call in self.calls)
+        try:
+            completed = export_calls(
+                self.filename, self.calls, self.criteria,
+                progress=self.progress.emit, is_running=lambda: self.running
+            )
+        except Exception as e:
+            write_log(f"Export to {self.filename} failed: {e}")
+            self.done.emit(False, str(e))
+            return
+        if not completed:
+            # Недописанный файл не оставляем
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+            write_log(f"Export to {self.filename} canceled.")
+        else:
+            write_log(f"Export to {self.filename} finished.")
+        self.done.emit(completed, "")
 
 
 class LoginDialog(QDialog):
@@ -300,11 +316,11 @@ class SettingsDialog(QDialog):
     def __init__(self, config):
         super().__init__()
         self.setWindowTitle("Настройки")
-        self.setFixedSize(600, 400)
+        self.setFixedSize(600, 520)
         self.config = config
 
         from PyQt5.QtWidgets import (QVBoxLayout, QHBoxLayout, QGroupBox,
-                                     QTableWidget, QTableWidgetItem, QPushButton)
+                                     QTableWidget, QTableWidgetItem, QPushButton, QCheckBox)
 
         main_layout = QVBoxLayout(self)
         general_group = QGroupBox("Общие настройки")
@@ -322,8 +338,28 @@ class SettingsDialog(QDialog):
         self.threshold_line_edit = QLineEdit(self)
         self.threshold_line_edit.setText(str(self.config.get("highlight_threshold", 40)))
 
+        self.workers_line_edit = QLineEdit(self)
+        self.workers_line_edit.setText(str(self.config.get("download_workers", DEFAULT_WORKERS)))
+
+        self.limit_line_edit = QLineEdit(self)
+        self.limit_line_edit.setText(str(self.config.get("download_limit_kbps", 0)))
+
+        self.cache_line_edit = QLineEdit(self)
+        self.cache_line_edit.setText(str(self.config.get("cache_limit_mb", 0)))
+
+        self.metadata_check = QCheckBox("Скачивать только список звонков, записи — при прослушивании", self)
+        self.metadata_check.setChecked(self.config.get("metadata_only", False))
+
+        self.poll_line_edit = QLineEdit(self)
+        self.poll_line_edit.setText(str(self.config.get("poll_interval", 60)))
+
         general_layout.addRow("Путь для сохранения файлов:", path_layout)
         general_layout.addRow("Порог длительности (сек.):", self.threshold_line_edit)
+        general_layout.addRow(f"Параллельных загрузок, не более (1-{MAX_WORKERS}):", self.workers_line_edit)
+        general_layout.addRow("Ограничение скорости, КБ/с (0 — нет):", self.limit_line_edit)
+        general_layout.addRow("Кэш записей, МБ (0 — без ограничения):", self.cache_line_edit)
+        general_layout.addRow("Проверять новые звонки, сек. (0 — нет):", self.poll_line_edit)
+        general_layout.addRow(self.metadata_check)
         main_layout.addWidget(general_group)
 
         mapping_group = QGroupBox("Соответствия Аккаунт/Номер → Имя сотрудника")
@@ -386,9 +422,31 @@ class SettingsDialog(QDialog):
             new_threshold = int(self.threshold_line_edit.text().strip())
         except:
             new_threshold = 40
+        try:
+            new_workers = int(self.workers_line_edit.text().strip())
+        except:
+            new_workers = DEFAULT_WORKERS
+        new_workers = max(1, min(new_workers, MAX_WORKERS))
+        try:
+            new_limit = max(0, int(self.limit_line_edit.text().strip()))
+        except:
+            new_limit = 0
+        try:
+            new_cache = max(0, int(self.cache_line_edit.text().strip()))
+        except:
+            new_cache = 0
+        try:
+            new_poll = max(0, int(self.poll_line_edit.text().strip()))
+        except:
+            new_poll = 60
 
         self.config["download_path"] = new_path
         self.config["highlight_threshold"] = new_threshold
+        self.config["download_workers"] = new_workers
+        self.config["download_limit_kbps"] = new_limit
+        self.config["cache_limit_mb"] = new_cache
+        self.config["poll_interval"] = new_poll
+        self.config["metadata_only"] = self.metadata_check.isChecked()
 
         new_mapping = {}
         for row in range(self.mapping_table.rowCount()):
@@ -405,104 +463,183 @@ class SettingsDialog(QDialog):
         self.accept()
 
 
+class PerformanceDialog(QDialog):
+    """
+    Замеры текущего сеанса: время горячих участков и счетчики.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Производительность")
+        self.resize(640, 420)
+
+        layout = QVBoxLayout(self)
+        self.started_label = QLabel(self)
+        self.table = QTableWidget(self)
+        self.table.setColumnCount(5)
+        self.table.setHorizontalHeaderLabels(["Участок / счетчик", "Замеров", "Всего, с", "Среднее, мс", "Макс., мс"])
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+
+        buttons = QHBoxLayout()
+        refresh_button = QPushButton("Обновить")
+        refresh_button.clicked.connect(self.refresh)
+        save_button = QPushButton("Сохранить отчет")
+        save_button.clicked.connect(self.save_report)
+        close_button = QPushButton("Закрыть")
+        close_button.clicked.connect(self.accept)
+        buttons.addWidget(refresh_button)
+        buttons.addWidget(save_button)
+        buttons.addStretch()
+        buttons.addWidget(close_button)
+
+        layout.addWidget(self.started_label)
+        layout.addWidget(self.table)
+        layout.addLayout(buttons)
+        self.refresh()
+
+    def refresh(self):
+        snapshot = metrics.snapshot()
+        self.started_label.setText(f"Замеры с {snapshot['started'].replace('T', ' ')}")
+        spans = sorted(snapshot["spans"].items(), key=lambda item: item[1]["total"], reverse=True)
+        counters = sorted(snapshot["counters"].items())
+        self.table.setRowCount(len(spans) + len(counters))
+        for row, (name, entry) in enumerate(spans):
+            values = [name, str(entry["count"]), f"{entry['total']:.2f}",
+                      f"{entry['total'] * 1000 / entry['count']:.1f}", f"{entry['max'] * 1000:.1f}"]
+            for col, value in enumerate(values):
+                self.table.setItem(row, col, QTableWidgetItem(value))
+        for row, (name, value) in enumerate(counters, start=len(spans)):
+            self.table.setItem(row, 0, QTableWidgetItem(name))
+            self.table.setItem(row, 1, QTableWidgetItem(str(value)))
+            for col in range(2, 5):
+                self.table.setItem(row, col, QTableWidgetItem(""))
+
+    def save_report(self):
+        try:
+            path = write_summary(PERF_DIR, "gui")
+            write_prometheus(PERF_DIR, "gui")
+        except OSError as e:
+            QMessageBox.warning(self, "Ошибка", f"Не удалось сохранить отчет: {e}")
+            return
+        QMessageBox.information(self, "Производительность", f"Отчет сохранен: {path}")
+
+
+class StatsDialog(QDialog):
+    """
+    Статистика за период по аккаунтам, сотрудникам или дням. Строится
+    из итогов call_stats.CallStats, поэтому не зависит от числа звонков.
+    """
+    GROUPS = ["По аккаунтам", "По сотрудникам", "По дням"]
+
+    def __init__(self, stats, account_mapping, period_dates, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Статистика звонков")
+        self.resize(1100, 520)
+        self.stats = stats
+        self.account_mapping = account_mapping
+        self.period_dates = period_dates
+
+        layout = QVBoxLayout(self)
+        controls = QHBoxLayout()
+        self.period_box = QComboBox()
+        self.period_box.addItems(PERIODS)
+        self.start_date_edit = QDateEdit(calendarPopup=True)
+        self.start_date_edit.setDate(QDate.currentDate().addDays(-30))
+        self.end_date_edit = QDateEdit(calendarPopup=True)
+        self.end_date_edit.setDate(QDate.currentDate())
+        self.group_box = QComboBox()
+        self.group_box.addItems(self.GROUPS)
+        controls.addWidget(QLabel("Период:"))
+        controls.addWidget(self.period_box)
+        controls.addWidget(self.start_date_edit)
+        controls.addWidget(self.end_date_edit)
+        controls.addWidget(QLabel("Группировка:"))
+        controls.addWidget(self.group_box)
+        controls.addStretch()
+
+        self.table = QTableWidget(self)
+        self.headers = (["Группа", "Входящих", "Исходящих", "Пропущенных", "Всего",
+                         "Ср. разговор", "Время разговоров"]
+                        + list(HISTOGRAM_LABELS)
+                        + [f"{c} 🟢/🔴" for c in CRITERIA])
+        self.table.setColumnCount(len(self.headers))
+        self.table.setHorizontalHeaderLabels(self.headers)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+
+        buttons = QHBoxLayout()
+        close_button = QPushButton("Закрыть")
+        close_button.clicked.connect(self.accept)
+        buttons.addStretch()
+        buttons.addWidget(close_button)
+
+        layout.addLayout(controls)
+        layout.addWidget(self.table)
+        layout.addLayout(buttons)
+
+        self.period_box.currentIndexChanged.connect(self.refresh)
+        self.start_date_edit.dateChanged.connect(self.refresh)
+        self.end_date_edit.dateChanged.connect(self.refresh)
+        self.group_box.currentIndexChanged.connect(self.refresh)
+        self.refresh()
+
+    def group_key(self):
+        group = self.group_box.currentText()
+        if group == "По сотрудникам":
+            mapping = self.account_mapping
+            return lambda date_key, account: mapping.get(account) or account
+        if group == "По дням":
+            return lambda date_key, account: date_key
+        return None
+
+    def refresh(self):
+        period = self.period_box.currentText()
+        custom = period == "Произвольный период"
+        self.start_date_edit.setVisible(custom)
+        self.end_date_edit.setVisible(custom)
+        start_date, end_date = self.period_dates({
+            "period": period,
+            "start": self.start_date_edit.date().toPyDate().isoformat(),
+            "end": self.end_date_edit.date().toPyDate().isoformat()
+        })
+        with span("gui.stats"):
+            groups = self.stats.summary(start_date, end_date, self.group_key())
+        reverse = self.group_box.currentText() == "По дням"
+        rows = sorted(groups.items(), key=lambda item: item[0], reverse=reverse)
+        total = StatsCell()
+        for _, cell in rows:
+            total.merge(cell)
+        rows.append(("Итого", total))
+
+        self.table.setRowCount(len(rows))
+        for row, (name, cell) in enumerate(rows):
+            values = [name, cell.incoming, cell.outgoing, cell.missed, cell.total,
+                      format_seconds(cell.mean_duration), format_seconds(cell.talk_seconds)]
+            values += cell.histogram
+            values += [f"{cell.marks.get((c, 'green'), 0)} / {cell.marks.get((c, 'red'), 0)}" for c in CRITERIA]
+            for col, value in enumerate(values):
+                self.table.setItem(row, col, QTableWidgetItem(str(value)))
+
+
 class RebuildWorker(QObject):
     """
     Фоновый объект для пересборки (rebuild) структуры folder_info.
+    По умолчанию пересборка инкрементальная: в folder_info добавляются только
+    файлы из downloads, которых еще нет в индексе звонков.
     """
     finished = pyqtSignal()
 
-    def __init__(self, config):
+    def __init__(self, config, store, full=False):
         super().__init__()
         self.config = config
+        self.store = store
+        self.full = full
+        self.added_calls = []
 
     def run(self):
-        self._rebuild_folder_info()
+        self.added_calls = rebuild_calls(self.config, self.store, self.full)
         self.finished.emit()
 
-    def format_duration(self, seconds):
-        seconds = int(seconds)
-        h = seconds // 3600
-        m = (seconds % 3600) // 60
-        s = seconds % 60
-        return f"{h:02d}:{m:02d}:{s:02d}"
-
-    def _rebuild_folder_info(self):
-        old_folder_info = self.config.get("folder_info", {})
-        new_folder_info = {}
-        last_week_date = datetime.now().date() - timedelta(days=7)
-
-        for filename, local_path in self.config.get("downloads", {}).items():
-            parsed = self.parse_filename(filename)
-            if not parsed:
-                continue
-
-            call_date_str = parsed["date"]
-            call_date = datetime.strptime(call_date_str, "%Y-%m-%d").date()
-            day_of_week = datetime.strptime(call_date_str, "%Y-%m-%d").strftime("%A")
-
-            if call_date_str not in new_folder_info:
-                new_folder_info[call_date_str] = {
-                    "day": day_of_week,
-                    "incoming": 0,
-                    "outgoing": 0,
-                    "calls": []
-                }
-
-            call_type = "Входящий" if parsed["type"] == "in" else "Исходящий"
-            number = re.sub(r"\D", "", parsed["number"])
-            call_time = f"{parsed['date']} {parsed['time']}"
-
-            if call_date > last_week_date:
-                try:
-                    audio = AudioSegment.from_file(local_path, format="mp3")
-                    duration_seconds = len(audio) / 1000.0
-                    duration_str = self.format_duration(duration_seconds)
-                except Exception as e:
-                    write_log(f"Ошибка определения длительности {filename}: {e}")
-                    duration_str = "Неизвестно"
-            else:
-                duration_str = "Неизвестно"
-
-            old_marks = {}
-            for old_date, old_data in old_folder_info.items():
-                for old_call in old_data.get("calls", []):
-                    if old_call.get("filename") == filename:
-                        old_marks = old_call.get("marks", {})
-                        break
-
-            call_data = {
-                "filename": filename,
-                "type": call_type,
-                "number": number,
-                "account": parsed["account"],
-                "datetime": call_time,
-                "duration": duration_str,
-                "marks": old_marks
-            }
-
-            if parsed["type"] == "in":
-                new_folder_info[call_date_str]["incoming"] += 1
-            else:
-                new_folder_info[call_date_str]["outgoing"] += 1
-
-            new_folder_info[call_date_str]["calls"].append(call_data)
-
-        self.config["folder_info"] = new_folder_info
-        save_config(self.config)
-
-    def parse_filename(self, filename):
-        pattern = (r"(?P<account>[\w\d]+)_(?P<type>in|out)_(?P<date>\d{4}_\d{2}_\d{2})-"
-                   r"(?P<time>\d{2}_\d{2}_\d{2})_(?P<number>[\d]+)")
-        match = re.match(pattern, filename)
-        if match:
-            data = match.groupdict()
-            data["date"] = data["date"].replace("_", "-")
-            data["time"] = data["time"].replace("_", ":")
-            data["number"] = re.sub(r"\D", "", data["number"])
-            return data
-        else:
-            return None
-
 
 class FTPApp(QMainWindow):
     """
@@ -511,6 +648,15 @@ class FTPApp(QMainWindow):
     def __init__(self):
         super().__init__()
         self.config = load_config()
+        self.store = CallStore()
+        self.store.migrate_from_config(self.config)
+        migrate_recording_layout(self.store)
+        self.store.load_into(self.config)
+        self.call_columns = CallColumns()
+        self.call_columns.load(self.config["folder_info"])
+        self.filter_engine = FilterEngine(self.call_columns)
+        # Растет при каждой отметке: результаты фильтра по критерию устаревают
+        self.marks_version = 0
         self.ftplog = self.config.get("login", "")
         self.pas = None
 
@@ -529,6 +675,14 @@ class FTPApp(QMainWindow):
         export_action.triggered.connect(self.export_to_xlsx)
         self.toolbar.addAction(export_action)
 
+        stats_action = QAction("Статистика", self)
+        stats_action.triggered.connect(self.open_stats)
+        self.toolbar.addAction(stats_action)
+
+        perf_action = QAction("Производительность", self)
+        perf_action.triggered.connect(self.open_performance)
+        self.toolbar.addAction(perf_action)
+
         # Основной лэйаут
         self.layout_main = QVBoxLayout()
         central = QWidget()
@@ -546,9 +700,7 @@ class FTPApp(QMainWindow):
         self.to_number_input.setPlaceholderText("Куда звонили")
 
         self.period_box = QComboBox()
-        periods = ["Все", "Сегодня", "Вчера", "Текущая неделя", "Прошлая неделя",
-                   "Текущий месяц", "Прошлый месяц", "Произвольный период"]
-        for p in periods:
+        for p in PERIODS:
             self.period_box.addItem(p)
 
         self.start_date_edit = QDateEdit(calendarPopup=True)
@@ -584,6 +736,17 @@ class FTPApp(QMainWindow):
         self.reset_button = QPushButton("Сбросить")
         self.reset_button.clicked.connect(self.reset_filters)
 
+        self.preset_box = QComboBox()
+        self.preset_box.setMinimumWidth(180)
+        self.reload_presets()
+        self.preset_box.activated.connect(self.apply_preset)
+
+        self.save_preset_button = QPushButton("Сохранить пресет")
+        self.save_preset_button.clicked.connect(self.save_preset)
+
+        self.delete_preset_button = QPushButton("Удалить пресет")
+        self.delete_preset_button.clicked.connect(self.delete_preset)
+
         self.criteria_filter_box = QComboBox()
         self.criteria_filter_box.addItem("Без фильтра по критерию")
         for c in CRITERIA:
@@ -632,6 +795,11 @@ class FTPApp(QMainWindow):
         buttons_line_layout = QHBoxLayout()
         buttons_line_layout.addWidget(self.apply_button)
         buttons_line_layout.addWidget(self.reset_button)
+        buttons_line_layout.addStretch()
+        buttons_line_layout.addWidget(QLabel("Пресет:"))
+        buttons_line_layout.addWidget(self.preset_box)
+        buttons_line_layout.addWidget(self.save_preset_button)
+        buttons_line_layout.addWidget(self.delete_preset_button)
         self.search_main_layout.addLayout(buttons_line_layout)
 
         self.layout_main.addWidget(self.search_widget)
@@ -647,8 +815,9 @@ class FTPApp(QMainWindow):
 
         # Таблица «папок» (дат), когда звонки сделаны
         self.folder_table = QTableWidget()
-        self.folder_table.setColumnCount(5)
-        self.folder_table.setHorizontalHeaderLabels(["Дата", "День недели", "Входящих", "Исходящих", "Всего"])
+        self.folder_table.setColumnCount(7)
+        self.folder_table.setHorizontalHeaderLabels(["Дата", "День недели", "Входящих", "Исходящих",
+                                                     "Пропущенных", "Всего", "Ср. разговор"])
         self.folder_table.cellDoubleClicked.connect(self.open_folder_from_table)
         self.folder_table.cellClicked.connect(self.display_folder_info_from_table)
         self.layout_main.addWidget(self.folder_table)
@@ -656,13 +825,32 @@ class FTPApp(QMainWindow):
         self.info_label_folder = QLabel("Информация о папке:")
         self.layout_main.addWidget(self.info_label_folder)
 
-        # Таблица с деталями звонков
-        base_columns = 8
-        total_columns = base_columns + len(CRITERIA)
-        self.call_table = QTableWidget()
-        self.call_table.setColumnCount(total_columns)
-        headers = ["№", "Тип", "Номер", "Аккаунт", "Длит.", "Время", "Прослушать", "Скачать"] + CRITERIA
-        self.call_table.setHorizontalHeaderLabels(headers)
+        # Таблица с деталями звонков: модель + делегаты вместо виджетов в ячейках
+        self.call_model = CallTableModel(CRITERIA, self)
+        self.call_table = QTableView()
+        self.call_table.setModel(self.call_model)
+        self.call_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.call_table.verticalHeader().setDefaultSectionSize(24)
+        self.call_table.setEditTriggers(QTableView.NoEditTriggers)
+        # Несколько строк (Shift/Ctrl, Ctrl+A) отмечаются разом через контекстное меню
+        self.call_table.setSelectionBehavior(QTableView.SelectRows)
+        self.call_table.setSelectionMode(QTableView.ExtendedSelection)
+        self.call_table.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.call_table.customContextMenuRequested.connect(self.show_mark_menu)
+
+        self.play_delegate = ButtonDelegate(self.call_table)
+        self.play_delegate.clicked.connect(lambda row: self.play_call(row, self.call_model.calls))
+        self.call_table.setItemDelegateForColumn(PLAY_COLUMN, self.play_delegate)
+
+        self.download_delegate = ButtonDelegate(self.call_table)
+        self.download_delegate.clicked.connect(lambda row: self.download_call(row, self.call_model.calls))
+        self.call_table.setItemDelegateForColumn(DOWNLOAD_COLUMN, self.download_delegate)
+
+        self.mark_delegate = MarkDelegate(self.call_table)
+        self.mark_delegate.marked.connect(self.set_mark)
+        for i in range(len(CRITERIA)):
+            self.call_table.setItemDelegateForColumn(len(BASE_HEADERS) + i, self.mark_delegate)
+            self.call_table.setColumnWidth(len(BASE_HEADERS) + i, 140)
         self.call_table.hide()
         self.layout_main.addWidget(self.call_table)
 
@@ -700,12 +888,33 @@ class FTPApp(QMainWindow):
 
         self.current_path = "/recordings"
         self.previous_paths = []
+        # Ход фоновой загрузки — в строке состояния, окно остается доступным
+        self.download_progress = QProgressBar()
+        self.download_progress.setRange(0, 100)
+        self.download_progress.setMaximumWidth(250)
+        self.stop_download_button = QPushButton("Остановить загрузку")
+        self.stop_download_button.clicked.connect(self.cancel_download)
+        self.statusBar().addPermanentWidget(self.download_progress)
+        self.statusBar().addPermanentWidget(self.stop_download_button)
+        self.download_progress.hide()
+        self.stop_download_button.hide()
+
         self.download_thread = None
         self.duration_thread = None
-        self.progress_dialog = None
+        self.fetch_thread = None
+        self.rebuild_thread = None
+        # Окно закрывается: сигналы, пришедшие после остановки потоков, новых не запускают
+        self.closing = False
+        # Действия, ждущие записи из FTP: {имя файла: функция(путь)}
+        self.pending_fetches = {}
+        # Несохраненные отметки: {(имя файла, критерий): цвет}
+        self.dirty_marks = {}
+        self.mark_flush_timer = QTimer(self)
+        self.mark_flush_timer.setSingleShot(True)
+        self.mark_flush_timer.setInterval(MARK_FLUSH_MS)
+        self.mark_flush_timer.timeout.connect(self.flush_marks)
         self.total_duration = 0
         self.current_playing_row = None
-        self.current_playing_button = None
 
         self.check_password()
 
@@ -745,66 +954,111 @@ class FTPApp(QMainWindow):
             QApplication.quit()
 
     def start_initial_download(self):
-        self.download_thread = DownloadThread(self.config, "XXX", self.ftplog, self.pas, 360)
-        self.progress_dialog = QProgressDialog("Идет загрузка файлов...", "Отмена", 0, 100, self)
-        self.progress_dialog.setWindowModality(Qt.WindowModal)
-        self.progress_dialog.setValue(0)
-        self.progress_dialog.show()
-
-        self.download_thread.progress.connect(self.progress_dialog.setValue)
-        self.download_thread.status.connect(self.info_label.setText)
-        self.progress_dialog.canceled.connect(self.cancel_download)
-        self.download_thread.finished.connect(self.finish_initial_download)
-        self.download_thread.start()
-
-    def cancel_download(self):
-        if self.download_thread and self.download_thread.isRunning():
-            self.download_thread.running = False
-            self.download_thread.wait()
-            self.info_label.setText("Загрузка отменена пользователем.")
-        if self.progress_dialog:
-            self.progress_dialog.close()
-
-    def finish_initial_download(self):
-        self.info_label.setText("Загрузка завершена.")
-        if self.progress_dialog:
-            self.progress_dialog.close()
-
-        self.download_thread = None
+        """
+        Сначала в индекс добавляется то, что уже скачано, и окно сразу
+        становится рабочим; загрузка с FTP идет потом в фоне.
+        """
+        self.fetch_thread = FetchThread(self.config, self.store, FTP_HOST, self.ftplog, self.pas)
+        self.fetch_thread.fetched.connect(self.on_recording_fetched)
+        self.fetch_thread.durations_updated.connect(self.on_duration_updated)
+        self.fetch_thread.start()
         self.show_custom_blocker("Обновление данных...")
 
         self.rebuild_thread = QThread()
-        self.rebuild_worker = RebuildWorker(self.config)
+        self.rebuild_worker = RebuildWorker(self.config, self.store)
         self.rebuild_worker.moveToThread(self.rebuild_thread)
 
         self.rebuild_thread.started.connect(self.rebuild_worker.run)
         self.rebuild_worker.finished.connect(self.rebuild_thread.quit)
-        self.rebuild_worker.finished.connect(self.rebuild_thread.deleteLater)
+        self.rebuild_thread.finished.connect(self.rebuild_thread.deleteLater)
+        self.rebuild_thread.finished.connect(self.on_rebuild_thread_finished)
         self.rebuild_worker.finished.connect(self.on_rebuild_finished)
 
         self.rebuild_thread.start()
 
     def on_rebuild_finished(self):
+        self.call_columns.extend(self.rebuild_worker.added_calls)
         self.update_folder_table_from_config()
-        self.start_duration_loading()
         self.hide_custom_blocker()
+        self.start_background_download()
+
+    def on_rebuild_thread_finished(self):
+        # После deleteLater обращаться к объекту потока нельзя
+        self.rebuild_thread = None
+
+    def start_background_download(self):
+        if self.closing:
+            return
+        self.download_thread = DownloadThread(self.config, self.store, FTP_HOST, self.ftplog, self.pas, 360,
+                                              keep=self.fetch_thread.protected)
+        self.download_progress.setValue(0)
+        self.download_progress.show()
+        self.stop_download_button.show()
+
+        self.download_thread.progress.connect(self.download_progress.setValue)
+        self.download_thread.status.connect(self.info_label.setText)
+        self.download_thread.new_calls.connect(self.on_new_calls)
+        # Опрос текущего дня не ждет догрузки старых дней
+        self.download_thread.priority_done.connect(self.start_watch)
+        self.download_thread.finished.connect(self.finish_download)
+        self.download_thread.start()
+
+    def cancel_download(self):
+        if self.download_thread and self.download_thread.isRunning():
+            self.download_thread.running = False
+            self.info_label.setText("Загрузка останавливается...")
+
+    def finish_download(self):
+        # Сигнал finished испускается из run(), поток еще может быть жив
+        if self.download_thread is not None:
+            self.download_thread.wait()
+            stopped = not self.download_thread.running
+            self.download_thread = None
+            self.info_label.setText("Загрузка отменена пользователем." if stopped else "Загрузка завершена.")
+        self.download_progress.hide()
+        self.stop_download_button.hide()
+        self.save_metrics()
+        self.start_duration_loading()
+        # Обычно опрос уже запущен по priority_done; здесь — если загрузка до догрузки не дошла
+        self.start_watch()
+
+    def start_watch(self):
+        if getattr(self, 'watch_thread', None) is not None or not self.pas or self.closing:
+            return
+        self.watch_thread = WatchThread(self.config, self.store, FTP_HOST, self.ftplog, self.pas)
+        self.watch_thread.new_calls.connect(self.on_new_calls)
+        self.watch_thread.start()
+
+    def on_new_calls(self, fetched, date_calls):
+        """
+        Новые звонки из загрузки или опроса добавляются в индекс и счетчики без пересборки.
+        """
+        self.config["downloads"].update(fetched)
+        added = index_calls(self.config["folder_info"], self.config["call_index"], date_calls)
+        if not added:
+            return
+        self.call_columns.extend(added)
+        if self.folder_table.isVisible():
+            self.update_folder_table_from_config()
+        if self.download_thread is None:
+            self.info_label.setText(f"Новых звонков: {len(added)} (последний {added[-1][1]['datetime']}).")
 
     def start_duration_loading(self):
-        self.duration_thread = DurationLoaderThread(self.config)
+        if self.closing:
+            return
+        self.duration_thread = DurationLoaderThread(self.config, self.store)
         self.duration_thread.updated.connect(self.on_duration_updated)
         self.duration_thread.start()
 
     def on_duration_updated(self):
+        self.call_columns.refresh_inexact_durations()
         if self.call_table.isVisible():
-            parts = self.current_path.split("/")
-            current_folder = parts[-1] if len(parts) > 1 else None
-            if current_folder and current_folder in self.config.get("folder_info", {}):
-                calls = self.config["folder_info"][current_folder].get("calls", [])
-                self.update_call_table_from_config(calls)
+            self.call_model.refresh_durations()
+        elif self.folder_table.isVisible():
+            self.update_folder_table_from_config()
 
     def apply_filters(self):
-        calls = self.get_all_calls_from_config()
-        filtered = self.filter_calls(calls)
+        filtered = self.filter_calls()
         self.show_calls(filtered)
 
     def reset_filters(self):
@@ -817,96 +1071,98 @@ class FTPApp(QMainWindow):
         self.custom_duration_input.clear()
         self.custom_duration_input.hide()
         self.route_input.clear()
+        self.preset_box.setCurrentIndex(0)
         self.update_folder_table_from_config()
 
-    def get_all_calls_from_config(self):
-        all_calls = []
-        folder_info = self.config.get("folder_info", {})
-        for date_key, data in folder_info.items():
-            calls = data.get("calls", [])
-            for c in calls:
-                c["date"] = date_key
-                if "marks" not in c:
-                    c["marks"] = {}
-                all_calls.append(c)
-        return all_calls
-
-    def filter_calls(self, calls):
-        search_number = self.search_number_input.text().strip()
-        from_number = self.from_number_input.text().strip()
-        to_number = self.to_number_input.text().strip()
-        route = self.route_input.text().strip()
-        account_mapping = self.config.get("account_mapping", {})
-        period = self.period_box.currentText()
-        start_date, end_date = self.get_period_dates(period)
-        call_type = self.call_type_box.currentText()
-
-        duration_filter = self.duration_box.currentText()
-        custom_duration = None
-        if duration_filter == "Другая...":
-            try:
-                custom_duration = int(self.custom_duration_input.text().strip())
-            except:
-                custom_duration = None
-
-        selected_criterion = self.criteria_filter_box.currentText()
-        selected_color = self.criteria_color_box.currentText()
-
-        filtered = []
-        for call in calls:
-            call_date = datetime.strptime(call["date"], "%Y-%m-%d").date()
-            if start_date and end_date and not (start_date <= call_date <= end_date):
-                continue
-
-            if call_type == "Входящий" and call["type"] != "Входящий":
-                continue
-            if call_type == "Исходящий" and call["type"] != "Исходящий":
-                continue
-            if call_type == "Пропущенный":
-                dur_sec = self.duration_to_seconds(call["duration"]) or 0
-                if call["type"] != "Входящий" or dur_sec > 0:
-                    continue
+    def reload_presets(self, current=None):
+        self.preset_box.blockSignals(True)
+        self.preset_box.clear()
+        self.preset_box.addItem("—")
+        self.preset_box.addItems(sorted(self.config.get("filter_presets", {})))
+        self.preset_box.setCurrentIndex(max(0, self.preset_box.findText(current)) if current else 0)
+        self.preset_box.blockSignals(False)
 
-            dur_sec = self.duration_to_seconds(call["duration"]) or 0
-            if duration_filter == "От 5 секунд" and dur_sec < 5:
-                continue
-            if duration_filter == "От 10 секунд" and dur_sec < 10:
-                continue
-            if duration_filter == "От 20 секунд" and dur_sec < 20:
-                continue
-            if duration_filter == "От 30 секунд" and dur_sec < 30:
-                continue
-            if duration_filter == "От 40 секунд" and dur_sec < 40:
-                continue
-            if duration_filter == "От 60 секунд (1 мин)" and dur_sec < 60:
-                continue
-            if duration_filter == "Другая..." and custom_duration is not None and dur_sec < custom_duration:
-                continue
+    def apply_preset(self, index):
+        if index <= 0:
+            return
+        state = self.config.get("filter_presets", {}).get(self.preset_box.currentText())
+        if state is None:
+            return
+        self.set_filter_state(state)
+        self.apply_filters()
+
+    def save_preset(self):
+        current = self.preset_box.currentText() if self.preset_box.currentIndex() > 0 else ""
+        name, ok = QInputDialog.getText(self, "Пресет фильтров", "Название пресета:", text=current)
+        name = name.strip()
+        if not ok or not name:
+            return
+        self.config.setdefault("filter_presets", {})[name] = self.filter_state()
+        save_config(self.config)
+        self.reload_presets(name)
 
-            if search_number:
-                if search_number not in call["number"] and search_number not in call["account"]:
-                    continue
-            if from_number and from_number not in call["number"]:
-                continue
-            if to_number and to_number not in call["account"]:
-                continue
+    def delete_preset(self):
+        if self.preset_box.currentIndex() <= 0:
+            return
+        name = self.preset_box.currentText()
+        if QMessageBox.question(self, "Пресет фильтров", f"Удалить пресет «{name}»?") != QMessageBox.Yes:
+            return
+        self.config.get("filter_presets", {}).pop(name, None)
+        save_config(self.config)
+        self.reload_presets()
 
-            acc = call["account"]
-            displayed_account = account_mapping.get(acc, acc)
-            if route:
-                # Проверяем текст для фильтра по маршруту
-                if route not in acc and route not in displayed_account:
-                    continue
+    def filter_state(self):
+        """
+        Текущее состояние панели фильтров; в таком же виде хранятся пресеты.
+        """
+        return {
+            "search": self.search_number_input.text().strip(),
+            "from_number": self.from_number_input.text().strip(),
+            "to_number": self.to_number_input.text().strip(),
+            "route": self.route_input.text().strip(),
+            "period": self.period_box.currentText(),
+            "start": self.start_date_edit.date().toPyDate().isoformat(),
+            "end": self.end_date_edit.date().toPyDate().isoformat(),
+            "call_type": self.call_type_box.currentText(),
+            "duration": self.duration_box.currentText(),
+            "custom_duration": self.custom_duration_input.text().strip(),
+            "criterion": None if self.criteria_filter_box.currentIndex() == 0 else self.criteria_filter_box.currentText(),
+            "color": self.criteria_color_box.currentText()
+        }
 
-            if selected_criterion != "Без фильтра по критерию":
-                mark_color = call["marks"].get(selected_criterion, None)
-                if selected_color == "Зеленый" and mark_color != "green":
-                    continue
-                elif selected_color == "Красный" and mark_color != "red":
-                    continue
+    def set_filter_state(self, state):
+        self.search_number_input.setText(state.get("search", ""))
+        self.from_number_input.setText(state.get("from_number", ""))
+        self.to_number_input.setText(state.get("to_number", ""))
+        self.route_input.setText(state.get("route", ""))
+        for key, edit in (("start", self.start_date_edit), ("end", self.end_date_edit)):
+            if state.get(key):
+                edit.setDate(QDate.fromString(state[key], Qt.ISODate))
+        self.custom_duration_input.setText(state.get("custom_duration", ""))
+        for box, value in ((self.period_box, state.get("period")),
+                           (self.call_type_box, state.get("call_type")),
+                           (self.duration_box, state.get("duration")),
+                           (self.criteria_filter_box, state.get("criterion")),
+                           (self.criteria_color_box, state.get("color"))):
+            index = box.findText(value) if value else 0
+            box.setCurrentIndex(max(0, index))
+
+    def period_dates_for_state(self, state):
+        if state.get("period") == "Произвольный период":
+            try:
+                return date.fromisoformat(state["start"]), date.fromisoformat(state["end"])
+            except (KeyError, TypeError, ValueError):
+                return None, None
+        return self.get_period_dates(state.get("period", "Все"))
 
-            filtered.append(call)
-        return filtered
+    @timed("gui.filter")
+    def filter_calls(self):
+        """
+        Состояние панели собирается в FilterPlan; повтор того же плана
+        при неизменных данных и отметках берется из кэша FilterEngine.
+        """
+        plan = compile_plan(self.filter_state(), self.period_dates_for_state, DURATION_THRESHOLDS)
+        return self.filter_engine.run(plan, self.config.get("account_mapping", {}), self.marks_version)
 
     def get_period_dates(self, period):
         today = date.today()
@@ -945,9 +1201,16 @@ class FTPApp(QMainWindow):
         self.update_call_table_from_config(calls, direct_list=True)
 
     def open_settings(self):
+        # Диалог меняет настройки в self.config на месте и сам сохраняет их
         dlg = SettingsDialog(self.config)
-        if dlg.exec_() == QDialog.Accepted:
-            self.config = load_config()
+        dlg.exec_()
+
+    def open_performance(self):
+        PerformanceDialog(self).exec_()
+
+    def open_stats(self):
+        StatsDialog(self.call_columns.stats, self.config.get("account_mapping", {}),
+                    self.period_dates_for_state, self).exec_()
 
     def change_speed(self, text):
         try:
@@ -1003,151 +1266,152 @@ class FTPApp(QMainWindow):
         self.back_button.setEnabled(True)
         self.hide_custom_blocker()
 
-    def create_mark_widget(self, call, criterion):
+    def set_mark(self, row, column, color):
         """
-        Виджет с двумя кнопками (зеленая/красная) для «отметок» по критерию.
+        Отметка («зеленая»/«красная») звонка по критерию из ячейки таблицы.
         """
-        widget = QWidget()
-        layout = QHBoxLayout()
-        layout.setContentsMargins(0, 0, 0, 0)
-
-        green_btn = QPushButton("🟢")
-        red_btn = QPushButton("🔴")
-        green_btn.setFixedSize(70, 20)
-        red_btn.setFixedSize(70, 20)
-
-        def set_green():
-            call["marks"][criterion] = "green"
-            save_config(self.config)
-            update_buttons()
-
-        def set_red():
-            call["marks"][criterion] = "red"
-            save_config(self.config)
-            update_buttons()
-
-        def update_buttons():
-            state = call["marks"].get(criterion)
-            green_btn.setStyleSheet("")
-            red_btn.setStyleSheet("")
-            if state == "green":
-                green_btn.setStyleSheet("background-color: lightgreen;")
-            elif state == "red":
-                red_btn.setStyleSheet("background-color: lightcoral;")
-
-        green_btn.clicked.connect(set_green)
-        red_btn.clicked.connect(set_red)
-        layout.addWidget(green_btn)
-        layout.addWidget(red_btn)
-        widget.setLayout(layout)
-
-        if criterion in call["marks"]:
-            state = call["marks"][criterion]
-            if state == "green":
-                green_btn.setStyleSheet("background-color: lightgreen;")
-            elif state == "red":
-                red_btn.setStyleSheet("background-color: lightcoral;")
-
-        return widget
+        self.mark_rows([row], self.call_model.criterion_for_column(column), color)
 
+    def mark_rows(self, rows, criterion, color):
+        """
+        Отмечает строки таблицы по критерию. В памяти отметка меняется сразу,
+        а в БД попадает пачкой: через MARK_FLUSH_MS после последнего изменения
+        или при закрытии окна.
+        """
+        calls = self.call_model.calls
+        rows = [row for row in rows if 0 <= row < len(calls)]
+        if not rows:
+            return
+        stats = self.call_columns.stats
+        for row in rows:
+            call = calls[row]
+            marks = call.setdefault("marks", {})
+            # Дата папки совпадает с датой звонка из имени файла
+            stats.update_mark(call["datetime"][:10], call, criterion, marks.get(criterion), color)
+            marks[criterion] = color
+            self.dirty_marks[(call["filename"], criterion)] = color
+        self.marks_version += 1
+        self.call_model.refresh_rows(rows)
+        self.mark_flush_timer.start()
+
+    def flush_marks(self):
+        self.mark_flush_timer.stop()
+        if not self.dirty_marks:
+            return
+        marks = [(filename, criterion, color) for (filename, criterion), color in self.dirty_marks.items()]
+        try:
+            self.store.set_marks(marks)
+        except Exception as e:
+            # Отметки остаются в памяти, попробуем при следующем сбросе
+            write_log(f"Saving marks failed: {e}")
+            self.mark_flush_timer.start()
+            return
+        self.dirty_marks.clear()
+        write_log(f"Marks saved: {len(marks)}", event="marks_flush")
+
+    def show_mark_menu(self, pos):
+        rows = sorted({index.row() for index in self.call_table.selectionModel().selectedRows()})
+        if not rows:
+            row = self.call_table.indexAt(pos).row()
+            if row < 0:
+                return
+            rows = [row]
+        menu = QMenu(self)
+        menu.addSection(f"Отметить выбранные звонки ({len(rows)})")
+        for criterion in self.call_model.criteria:
+            submenu = menu.addMenu(criterion)
+            for color, text in (("green", "🟢 Зеленый"), ("red", "🔴 Красный")):
+                action = submenu.addAction(text)
+                action.triggered.connect(
+                    lambda checked=False, c=criterion, col=color: self.mark_rows(rows, c, col)
+                )
+        menu.exec_(self.call_table.viewport().mapToGlobal(pos))
+
+    @timed("gui.table")
     def update_call_table_from_config(self, calls, direct_list=False):
         """
-        Отображает звонки в self.call_table.
+        Отображает звонки в self.call_table. Модель рисует только видимые строки.
         """
-        self.call_table.setRowCount(0)
-        highlight_threshold = self.config.get("highlight_threshold", 40)
-        account_mapping = self.config.get("account_mapping", {})
-
         # Сохраняем текущий список звонков, чтобы при экспорте в XLSX можно было выгрузить именно то, что видим.
         self.current_displayed_calls = calls[:]
-
-        base_columns = 8
-        for row_position, call in enumerate(calls):
-            self.call_table.insertRow(row_position)
-            item_num = QTableWidgetItem(str(row_position + 1))
-            duration_seconds = self.duration_to_seconds(call.get("duration", "Неизвестно"))
-            if duration_seconds is not None:
-                if duration_seconds > highlight_threshold:
-                    item_num.setBackground(Qt.green)
-                elif duration_seconds < 10:
-                    item_num.setBackground(Qt.red)
-            self.call_table.setItem(row_position, 0, item_num)
-
-            self.call_table.setItem(row_position, 1, QTableWidgetItem(call["type"]))
-
-            # Отображаем подмену по account_mapping
-            displayed_number = account_mapping.get(call["number"], call["number"])
-            displayed_account = account_mapping.get(call["account"], call["account"])
-
-            self.call_table.setItem(row_position, 2, QTableWidgetItem(displayed_number))
-            self.call_table.setItem(row_position, 3, QTableWidgetItem(displayed_account))
-
-            duration = call["duration"] if call["duration"] else "Идет загрузка..."
-            self.call_table.setItem(row_position, 4, QTableWidgetItem(duration))
-            self.call_table.setItem(row_position, 5, QTableWidgetItem(call["datetime"]))
-
-            play_button = QPushButton("▶")
-            play_button.clicked.connect(lambda checked, r=row_position, c=calls: self.play_call(r, c))
-            self.call_table.setCellWidget(row_position, 6, play_button)
-
-            download_button = QPushButton("Скачать")
-            download_button.clicked.connect(lambda checked, r=row_position, c=calls: self.download_call(r, c))
-            self.call_table.setCellWidget(row_position, 7, download_button)
-
-            if "marks" not in call:
-                call["marks"] = {}
-
-            for i, crit in enumerate(CRITERIA):
-                column_index = base_columns + i
-                widget = self.create_mark_widget(call, crit)
-                self.call_table.setCellWidget(row_position, column_index, widget)
+        self.call_model.set_calls(
+            self.current_displayed_calls,
+            self.config.get("account_mapping", {}),
+            self.config.get("highlight_threshold", 40)
+        )
+        self.current_playing_row = None
 
         self.folder_table.hide()
         self.call_table.show()
 
     def display_folder_info_from_table(self, row, column):
         folder_name = self.folder_table.item(row, 0).text()
-        info = self.config["folder_info"].get(folder_name, {})
-        day = info.get("day", "Неизвестно")
-        incoming = info.get("incoming", 0)
-        outgoing = info.get("outgoing", 0)
-        total_calls = incoming + outgoing
+        day = self.config["folder_info"].get(folder_name, {}).get("day", "Неизвестно")
+        cell = self.call_columns.stats.days.get(folder_name, StatsCell())
         self.info_label_folder.setText(
-            f"Дата: {folder_name} | День недели: {day} | Входящих: {incoming} | Исходящих: {outgoing} | Всего: {total_calls}"
+            f"Дата: {folder_name} | День недели: {day} | Входящих: {cell.incoming} | Исходящих: {cell.outgoing} | "
+            f"Пропущенных: {cell.missed} | Всего: {cell.total} | "
+            f"Время разговоров: {format_seconds(cell.talk_seconds)}"
         )
 
     def update_folder_table_from_config(self):
+        """
+        Дни берутся из итогов CallStats: они уже отсортированы и посчитаны.
+        """
         folder_info = self.config.get("folder_info", {})
-        folders = sorted(folder_info.keys(), key=lambda x: datetime.strptime(x, "%Y-%m-%d"), reverse=True)
-        self.folder_table.setRowCount(0)
+        stats = self.call_columns.stats
+        folders = stats.day_keys[::-1]
+        self.folder_table.setRowCount(len(folders))
         for i, folder in enumerate(folders):
-            info = folder_info[folder]
-            day = info.get("day", "Неизвестно")
-            incoming = info.get("incoming", 0)
-            outgoing = info.get("outgoing", 0)
-            total_calls = incoming + outgoing
-            self.folder_table.insertRow(i)
-            self.folder_table.setItem(i, 0, QTableWidgetItem(folder))
-            self.folder_table.setItem(i, 1, QTableWidgetItem(day))
-            self.folder_table.setItem(i, 2, QTableWidgetItem(str(incoming)))
-            self.folder_table.setItem(i, 3, QTableWidgetItem(str(outgoing)))
-            self.folder_table.setItem(i, 4, QTableWidgetItem(str(total_calls)))
+            cell = stats.days[folder]
+            day = folder_info.get(folder, {}).get("day", "Неизвестно")
+            values = [folder, day, cell.incoming, cell.outgoing, cell.missed, cell.total,
+                      format_seconds(cell.mean_duration)]
+            for col, value in enumerate(values):
+                self.folder_table.setItem(i, col, QTableWidgetItem(str(value)))
 
         self.call_table.hide()
         self.folder_table.show()
 
-    def duration_to_seconds(self, duration_str):
-        if duration_str in ("Неизвестно", "Ошибка"):
-            return None
-        parts = duration_str.split(":")
-        if len(parts) == 3:
-            try:
-                h, m, s = map(int, parts)
-                return h * 3600 + m * 60 + s
-            except:
-                return None
+    def local_recording(self, filename):
+        """
+        Путь к записи, если она есть в кэше, иначе None.
+        """
+        local_filename = self.config.get("downloads", {}).get(filename)
+        if local_filename and os.path.exists(local_filename):
+            return local_filename
         return None
 
+    def request_recording(self, filename, action):
+        """
+        Запись не в кэше: она скачивается в фоне, после чего вызывается action(путь).
+        """
+        if self.fetch_thread is None:
+            QMessageBox.warning(self, "Ошибка", "Файл не найден локально.")
+            return
+        self.pending_fetches[filename] = action
+        self.info_label.setText("Запись загружается с сервера...")
+        self.fetch_thread.request(filename, urgent=True)
+
+    def on_recording_fetched(self, filename, path, error):
+        if path:
+            self.config["downloads"][filename] = path
+        action = self.pending_fetches.pop(filename, None)
+        if action is None:
+            return
+        if error:
+            QMessageBox.warning(self, "Ошибка", f"Не удалось получить запись с сервера: {error}")
+            return
+        self.info_label.setText("Запись загружена.")
+        action(path)
+
+    def prefetch_after(self, row, calls):
+        if self.fetch_thread is None:
+            return
+        for call in calls[row + 1:row + 1 + PREFETCH_ROWS]:
+            if self.local_recording(call["filename"]) is None:
+                self.fetch_thread.request(call["filename"])
+
     def play_call(self, row, calls):
         if self.player.state() == QMediaPlayer.PlayingState:
             self.player.stop()
@@ -1155,9 +1419,14 @@ class FTPApp(QMainWindow):
 
         if calls and 0 <= row < len(calls):
             filename = calls[row]["filename"]
-            local_filename = self.config.get("downloads", {}).get(filename)
-            if not local_filename or not os.path.exists(local_filename):
-                QMessageBox.warning(self, "Ошибка", "Файл не найден локально.")
+            local_filename = self.local_recording(filename)
+            if local_filename is None:
+                # Играем, только если пользователь не ушел к другой выборке
+                self.request_recording(
+                    filename,
+                    lambda path: self.current_displayed_calls is calls and self.play_call(row, calls)
+                )
+                self.prefetch_after(row, calls)
                 return
             try:
                 file_url = QUrl.fromLocalFile(local_filename)
@@ -1166,26 +1435,27 @@ class FTPApp(QMainWindow):
                 self.highlight_current_playing_button(row)
             except Exception as e:
                 QMessageBox.warning(self, "Ошибка воспроизведения", f"Не удалось воспроизвести файл: {e}")
+                return
+            self.store.touch_recordings([filename])
+            if self.fetch_thread is not None:
+                with self.fetch_thread.lock:
+                    self.fetch_thread.keep = {filename}
+            self.prefetch_after(row, calls)
 
     def highlight_current_playing_button(self, row):
-        play_widget = self.call_table.cellWidget(row, 6)
-        if isinstance(play_widget, QPushButton):
-            play_widget.setStyleSheet("background-color: lightgreen;")
+        self.call_model.set_playing_row(row)
         self.current_playing_row = row
-        self.current_playing_button = play_widget
 
     def clear_current_playing_highlight(self):
-        if self.current_playing_button is not None:
-            self.current_playing_button.setStyleSheet("")
-        self.current_playing_button = None
+        self.call_model.set_playing_row(None)
         self.current_playing_row = None
 
     def download_call(self, row, calls):
         if calls and 0 <= row < len(calls):
             filename = calls[row]["filename"]
-            local_filename = self.config.get("downloads", {}).get(filename)
-            if not local_filename or not os.path.exists(local_filename):
-                QMessageBox.warning(self, "Ошибка", "Файл не найден локально.")
+            local_filename = self.local_recording(filename)
+            if local_filename is None:
+                self.request_recording(filename, lambda path: self.download_call(row, calls))
                 return
 
             initial_dir = self.config.get("download_path", "Загрузки")
@@ -1205,6 +1475,7 @@ class FTPApp(QMainWindow):
             try:
                 from shutil import copyfile
                 copyfile(local_filename, target_path)
+                self.store.touch_recordings([filename])
                 QMessageBox.information(self, "Сохранение", f"Файл успешно сохранен в:\n{target_path}")
             except Exception as e:
                 QMessageBox.warning(self, "Ошибка", f"Не удалось сохранить файл: {e}")
@@ -1228,61 +1499,74 @@ class FTPApp(QMainWindow):
                 self.back_button.setEnabled(False)
 
     def export_to_xlsx(self):
-        filename, _ = QFileDialog.getSaveFileName(
+        if not getattr(self, 'current_displayed_calls', None):
+            QMessageBox.information(self, "Экспорт", "Нет данных для выгрузки.")
+            return
+        if getattr(self, 'export_thread', None) is not None and self.export_thread.isRunning():
+            QMessageBox.information(self, "Экспорт", "Предыдущая выгрузка еще не завершена.")
+            return
+        filename, selected_filter = QFileDialog.getSaveFileName(
             self,
             "Сохранить как...",
             self.config.get("download_path", ""),
-            "Excel Files (*.xlsx)"
+            "Excel Files (*.xlsx);;CSV (*.csv);;TSV (*.tsv)"
         )
         if not filename:
             return
-        if not hasattr(self, 'current_displayed_calls') or not self.current_displayed_calls:
-            QMessageBox.information(self, "Экспорт", "Нет данных для выгрузки.")
-            return
-        filtered = self.current_displayed_calls
-        if not filtered:
-            QMessageBox.information(self, "Экспорт", "Нет данных для выгрузки.")
-            return
-
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Звонки"
-        headers = ["№", "Тип звонка", "Номер", "Аккаунт", "Длит. звонка", "Время"] + CRITERIA
-        ws.append(headers)
-
-        for i, call in enumerate(filtered, start=1):
-            row = [
-                i, call["type"], call["number"], call["account"],
-                call["duration"], call["datetime"]
-            ]
-            for crit in CRITERIA:
-                mark = call["marks"].get(crit, "")
-                if mark == "green":
-                    val = "Зеленый"
-                elif mark == "red":
-                    val = "Красный"
-                else:
-                    val = ""
-                row.append(val)
-            ws.append(row)
-
-        # Автоматическая подстройка ширины
-        for col in ws.columns:
-            max_length = 0
-            column = col[0].column_letter
-            for cell in col:
-                val = cell.value
-                if val and isinstance(val, str):
-                    length = len(val)
-                    if length > max_length:
-                        max_length = length
-            ws.column_dimensions[column].width = max_length + 2
+        ext = os.path.splitext(filename)[1].lower()
+        if ext not in (".xlsx", ".csv", ".tsv"):
+            # Расширение не указано — берем его из выбранного фильтра
+            ext = re.search(r"\*(\.\w+)", selected_filter).group(1) if selected_filter else ".xlsx"
+            filename += ext
+
+        calls = list(self.current_displayed_calls)
+        if ext == ".xlsx" and len(calls) > XLSX_MAX_ROWS:
+            QMessageBox.warning(self, "Экспорт", "Выборка не помещается на лист Excel, выгрузка будет в CSV.")
+            filename = os.path.splitext(filename)[0] + ".csv"
+        elif ext == ".xlsx" and len(calls) > LARGE_EXPORT_ROWS:
+            answer = QMessageBox.question(
+                self, "Экспорт",
+                f"Выбрано {len(calls)} звонков. Сохранить в CSV? Это значительно быстрее.",
+                QMessageBox.Yes | QMessageBox.No
+            )
+            if answer == QMessageBox.Yes:
+                filename = os.path.splitext(filename)[0] + ".csv"
+
+        self.export_progress = QProgressDialog("Идет выгрузка...", "Отмена", 0, 100, self)
+        self.export_progress.setWindowModality(Qt.NonModal)
+        self.export_progress.setValue(0)
+        self.export_progress.show()
+
+        self.export_thread = ExportThread(filename, calls, CRITERIA, self.store)
+        self.export_thread.progress.connect(self.export_progress.setValue)
+        self.export_thread.done.connect(self.on_export_done)
+        self.export_progress.canceled.connect(self.cancel_export)
+        self.export_thread.start()
+
+    def cancel_export(self):
+        if self.export_thread is not None:
+            self.export_thread.running = False
+
+    def on_export_done(self, completed, error):
+        self.export_progress.close()
+        filename = self.export_thread.filename
+        self.export_thread.wait()
+        self.export_thread = None
+        if error:
+            QMessageBox.warning(self, "Ошибка", f"Не удалось сохранить файл: {error}")
+        elif completed:
+            QMessageBox.information(self, "Экспорт", f"Данные успешно сохранены в {filename}")
 
+    def save_metrics(self, summary=False):
+        """
+        Обновляет gui.prom, а при summary еще и сохраняет сводку сеанса.
+        """
         try:
-            wb.save(filename)
-            QMessageBox.information(self, "Экспорт", f"Данные успешно сохранены в {filename}")
-        except Exception as e:
-            QMessageBox.warning(self, "Ошибка", f"Не удалось сохранить файл: {e}")
+            write_prometheus(PERF_DIR, "gui")
+            if summary:
+                write_log(f"Performance summary saved to {write_summary(PERF_DIR, 'gui')}")
+        except OSError as e:
+            write_log(f"Saving performance metrics failed: {e}")
 
     def show_custom_blocker(self, text="Подождите, идет загрузка..."):
         self.blocker_dialog = QDialog(self, Qt.FramelessWindowHint)
@@ -1317,6 +1601,28 @@ class FTPApp(QMainWindow):
 
     def closeEvent(self, event):
         write_log("Application is closing gracefully.")
+        # Все потоки, работающие с self.store, останавливаются до его закрытия
+        self.closing = True
+        if self.rebuild_thread is not None:
+            self.rebuild_thread.wait()
+        if self.download_thread is not None:
+            self.download_thread.running = False
+            self.download_thread.wait()
+        if self.fetch_thread is not None:
+            self.fetch_thread.running = False
+            self.fetch_thread.wait()
+        if getattr(self, 'watch_thread', None) is not None:
+            self.watch_thread.running = False
+            self.watch_thread.wait()
+        if getattr(self, 'export_thread', None) is not None:
+            self.export_thread.running = False
+            self.export_thread.wait()
+        if self.duration_thread is not None:
+            self.duration_thread.running = False
+            self.duration_thread.wait()
+        self.flush_marks()
+        self.save_metrics(summary=True)
+        self.store.close()
         super().closeEvent(event)
 
 
@@ -0,0 +1,288 @@
+"""
+Все права защищены (c) 2024.
+Определение длительности mp3-записей по заголовкам, без декодирования звука.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import struct
+
+from common import write_log
+
+# Битрейты (кбит/с) по индексу для (версия MPEG, слой)
+BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+BITRATES[(2, 3)] = BITRATES[(2, 2)]
+
+SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+# Сколько первых кадров сверяется, чтобы считать файл CBR
+CBR_CHECK_FRAMES = 8
+# Доли длины файла, где проверяется, что кадр CBR стоит на предсказанном месте
+# (1.0 — последний кадр), и допуск на выравнивание padding, байт
+CBR_CHECK_POINTS = (0.25, 0.5, 0.75, 1.0)
+CBR_POSITION_SLACK = 2
+HEAD_SIZE = 64 * 1024
+
+# Разбор заголовков упирается в чтение с диска, поэтому хватает пула потоков
+PROBE_WORKERS = min(8, (os.cpu_count() or 2) * 2)
+PROBE_CHUNK = 200
+
+
+class FrameHeader:
+    """
+    Разобранный 4-байтовый заголовок кадра MPEG Audio.
+    """
+    __slots__ = ("version", "layer", "bitrate", "sample_rate", "padding", "mono", "length", "samples")
+
+    def __init__(self, version, layer, bitrate, sample_rate, padding, mono):
+        self.version = version
+        self.layer = layer
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.mono = mono
+        if layer == 1:
+            self.samples = 384
+            self.length = (12 * bitrate // sample_rate + padding) * 4
+        elif layer == 3 and version != 1:
+            self.samples = 576
+            self.length = 72 * bitrate // sample_rate + padding
+        else:
+            self.samples = 1152
+            self.length = 144 * bitrate // sample_rate + padding
+
+
+def parse_frame_header(data, pos):
+    """
+    Возвращает FrameHeader для кадра по смещению pos или None, если там не заголовок.
+    """
+    if pos + 4 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+        return None
+    b1, b2, b3 = data[pos + 1], data[pos + 2], data[pos + 3]
+    version_bits = (b1 >> 3) & 0x03
+    layer_bits = (b1 >> 1) & 0x03
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 0x03
+    if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}[version_bits]
+    layer = 4 - layer_bits
+    bitrate = BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 0x01
+    mono = (b3 >> 6) == 3
+    return FrameHeader(version, layer, bitrate, sample_rate, padding, mono)
+
+
+def id3v2_size(data):
+    """
+    Размер тега ID3v2 в начале файла (0, если тега нет).
+    """
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = 0
+    for b in data[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def find_first_frame(data, start):
+    """
+    Ищет первый заголовок, за которым сразу следует еще один корректный кадр.
+    """
+    pos = data.find(b"\xff", start)
+    while 0 <= pos < len(data) - 4:
+        header = parse_frame_header(data, pos)
+        if header and header.length > 0:
+            next_pos = pos + header.length
+            if next_pos + 4 > len(data) or parse_frame_header(data, next_pos):
+                return pos, header
+        pos = data.find(b"\xff", pos + 1)
+    return None, None
+
+
+def vbr_header_duration(data, pos, header):
+    """
+    Длительность из заголовка Xing/Info или VBRI первого кадра, либо None.
+    """
+    if header.version == 1:
+        side_info = 17 if header.mono else 32
+    else:
+        side_info = 9 if header.mono else 17
+    xing = pos + 4 + side_info
+    if data[xing:xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+        if flags & 0x01:
+            frames = struct.unpack(">I", data[xing + 8:xing + 12])[0]
+            return frames * header.samples / header.sample_rate
+
+    vbri = pos + 4 + 32
+    if data[vbri:vbri + 4] == b"VBRI":
+        frames = struct.unpack(">I", data[vbri + 14:vbri + 18])[0]
+        return frames * header.samples / header.sample_rate
+    return None
+
+
+def cbr_frame_step(f, audio_start, audio_end, header):
+    """
+    Проверяет, что файл действительно CBR: кадры с тем же битрейтом должны
+    стоять там, где их предсказывает постоянная длина кадра, по всей длине
+    файла, включая последний кадр. Сверяются два варианта раскладки: средняя
+    длина с padding (как пишут кодировщики) и длина первого кадра без padding.
+    Возвращает подошедшую длину кадра в байтах или None (тогда нужен полный обход).
+    """
+    audio_size = audio_end - audio_start
+    steps = [header.bitrate * header.samples / 8 / header.sample_rate]
+    if not header.padding:
+        steps.append(header.length)
+    for step in steps:
+        frames = int(audio_size // step)
+        if frames < 2:
+            return step
+        for share in CBR_CHECK_POINTS:
+            predicted = audio_start + int(int((frames - 1) * share) * step)
+            f.seek(max(audio_start, predicted - CBR_POSITION_SLACK))
+            window = f.read(2 * CBR_POSITION_SLACK + 4)
+            if not any(
+                frame is not None and frame.bitrate == header.bitrate and frame.sample_rate == header.sample_rate
+                for frame in (parse_frame_header(window, i) for i in range(len(window) - 3))
+            ):
+                break
+        else:
+            return step
+    return None
+
+
+def probe_duration(path):
+    """
+    Длительность mp3 в секундах без декодирования: по заголовку Xing/Info/VBRI,
+    для CBR — по размеру файла и длине кадра (после проверки раскладки кадров
+    по всему файлу), иначе подсчетом заголовков кадров.
+    Для некорректных файлов бросает ValueError.
+    """
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        base = id3v2_size(f.read(10))
+        f.seek(base)
+        head = f.read(HEAD_SIZE)
+
+        pos, header = find_first_frame(head, 0)
+        if header is None:
+            raise ValueError("MPEG frame header not found")
+
+        duration = vbr_header_duration(head, pos, header)
+        if duration is not None:
+            return duration
+
+        # Короткая проверка: одинаковый битрейт у первых кадров — значит CBR
+        frames_checked = 0
+        check_pos = pos
+        cbr = True
+        while frames_checked < CBR_CHECK_FRAMES:
+            frame = parse_frame_header(head, check_pos)
+            if frame is None:
+                break
+            if frame.bitrate != header.bitrate:
+                cbr = False
+                break
+            frames_checked += 1
+            check_pos += frame.length
+
+        audio_end = file_size
+        f.seek(max(0, file_size - 128))
+        if f.read(3) == b"TAG":
+            audio_end -= 128
+        audio_start = base + pos
+        if cbr:
+            step = cbr_frame_step(f, audio_start, audio_end, header)
+            if step is not None:
+                return (audio_end - audio_start) / step * header.samples / header.sample_rate
+
+        # VBR без заголовка: проходим по всем заголовкам кадров
+        f.seek(audio_start)
+        data = f.read(audio_end - audio_start)
+
+    samples = 0
+    sample_rate = header.sample_rate
+    offset = 0
+    while offset + 4 <= len(data):
+        frame = parse_frame_header(data, offset)
+        if frame is None:
+            offset, frame = find_first_frame(data, offset + 1)
+            if frame is None:
+                break
+        samples += frame.samples
+        offset += frame.length
+    if not samples:
+        raise ValueError("no MPEG frames found")
+    return samples / sample_rate
+
+
+def get_duration(path):
+    """
+    Длительность записи в секундах. pydub (полное декодирование через ffmpeg)
+    используется только для файлов, которые не удалось разобрать по заголовкам.
+    """
+    try:
+        return probe_duration(path)
+    except (ValueError, struct.error) as e:
+        write_log(f"Header probe failed for {path}: {e}, falling back to pydub")
+    from pydub import AudioSegment
+    audio = AudioSegment.from_file(path, format="mp3")
+    return len(audio) / 1000.0
+
+
+def _probe_entry(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path, None, None, None
+    try:
+        duration = get_duration(path)
+    except Exception as e:
+        write_log(f"Error getting duration for {path}: {e}")
+        duration = None
+    return path, st.st_mtime, st.st_size, duration
+
+
+def probe_durations(paths, cache, executor):
+    """
+    Длительности для списка путей с учетом кэша {путь: (mtime, размер, длительность)}.
+    Файлы, которых нет в кэше или которые изменились, разбираются в executor.
+    Возвращает ({путь: длительность или None}, [новые записи кэша]).
+    """
+    durations = {}
+    to_probe = []
+    for path in paths:
+        cached = cache.get(path)
+        if cached is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                durations[path] = None
+                continue
+            if cached[0] == st.st_mtime and cached[1] == st.st_size:
+                durations[path] = cached[2]
+                continue
+        to_probe.append(path)
+
+    new_entries = []
+    for path, mtime, size, duration in executor.map(_probe_entry, to_probe):
+        durations[path] = duration
+        if duration is not None:
+            cache[path] = (mtime, size, duration)
+            new_entries.append((path, mtime, size, duration))
+    return durations, new_entries
@@ -0,0 +1,134 @@
+"""
+Все права защищены (c) 2024.
+Синхронизация записей АТС без GUI: для запуска из cron/планировщика
+или как постоянно работающий демон, чтобы к открытию FTPApp кэш записей
+и индекс звонков были уже готовы.
+
+    python -m pbx_sync --user LOGIN                 # один проход
+    python -m pbx_sync --user LOGIN --interval 300  # демон, проход раз в 5 минут
+
+Пароль берется из переменной окружения PBX_FTP_PASSWORD, а при запуске
+из терминала запрашивается. PyQt5 не импортируется.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import sys
+import signal
+import argparse
+import getpass
+import threading
+
+from common import FTP_HOST, PERF_DIR, write_log, load_config, use_log_file
+from call_store import CallStore
+from sync_core import download_recordings, rebuild_calls, load_durations, migrate_recording_layout
+from recording_cache import enforce_budget
+from perf_metrics import metrics, write_summary, write_prometheus
+
+PASSWORD_ENV = "PBX_FTP_PASSWORD"
+
+
+def parse_args(argv=None):
+    config = load_config()
+    parser = argparse.ArgumentParser(prog="pbx_sync", description="Синхронизация записей АТС без GUI.")
+    parser.add_argument("--host", default=FTP_HOST, help="FTP-сервер АТС")
+    parser.add_argument("--user", default=config.get("login", ""), help="логин FTP (по умолчанию из config.json)")
+    parser.add_argument("--days", type=int, default=360, help="за сколько последних дней скачивать записи")
+    parser.add_argument("--interval", type=int, default=0,
+                        help="пауза между проходами в секундах; 0 — один проход и выход")
+    parser.add_argument("--full-rebuild", action="store_true", help="полностью пересобрать индекс звонков")
+    parser.add_argument("--metadata-only", action="store_true",
+                        help="только индекс звонков по листингу FTP, без скачивания записей")
+    parser.add_argument("--quiet", action="store_true", help="не печатать ход синхронизации")
+    return parser.parse_args(argv)
+
+
+def get_password():
+    password = os.getenv(PASSWORD_ENV)
+    if password is None and sys.stdin.isatty():
+        password = getpass.getpass("Пароль FTP: ")
+    return password
+
+
+def sync_once(config, store, args, stop, status):
+    """
+    Один проход: скачивание новых записей, пересборка индекса и длительности.
+    """
+    downloaded = download_recordings(
+        config, store, args.host, args.user, args.password, args.days,
+        is_running=lambda: not stop.is_set(), status=status
+    )
+    if downloaded is None or stop.is_set():
+        return False
+    added = rebuild_calls(config, store, full=args.full_rebuild)
+    status(f"Новых звонков в индексе: {len(added)}")
+    updated = load_durations(config, store, is_running=lambda: not stop.is_set())
+    status(f"Определена длительность {updated} звонков.")
+    # Длительности уже сохранены в индексе, лишние записи можно удалять
+    evicted = enforce_budget(store, config.get("cache_limit_mb", 0) * 1024 * 1024)
+    if evicted:
+        status(f"Из кэша записей удалено {evicted} файлов.")
+    return True
+
+
+def save_metrics(status):
+    """
+    Сводка прохода в JSON и pbx_sync.prom для сборщика метрик; замеры
+    следующего прохода начинаются с нуля.
+    """
+    try:
+        write_prometheus(PERF_DIR, "pbx_sync")
+        path = write_summary(PERF_DIR, "pbx_sync")
+    except OSError as e:
+        write_log(f"Saving performance metrics failed: {e}")
+        return
+    metrics.reset()
+    status(f"Сводка замеров: {path}")
+
+
+# Свой файл лога: app.log ротирует GUI, а переименовывать открытый чужим процессом файл нельзя
+SYNC_LOG = "pbx_sync.log"
+
+
+def main(argv=None):
+    use_log_file(SYNC_LOG)
+    args = parse_args(argv)
+    if not args.user:
+        print("Не указан логин FTP (--user).", file=sys.stderr)
+        return 2
+    args.password = get_password()
+    if args.password is None:
+        print(f"Не задан пароль FTP: укажите его в {PASSWORD_ENV}.", file=sys.stderr)
+        return 2
+
+    status = (lambda message: None) if args.quiet else print
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop.set())
+
+    config = load_config()
+    if args.metadata_only:
+        config["metadata_only"] = True
+    store = CallStore()
+    store.migrate_from_config(config)
+    migrate_recording_layout(store)
+    store.load_into(config)
+    write_log(f"Headless sync started for {args.user}, interval {args.interval}s.")
+    try:
+        while True:
+            ok = sync_once(config, store, args, stop, status)
+            save_metrics(status)
+            # Полная пересборка нужна только на первом проходе
+            args.full_rebuild = False
+            if args.interval <= 0 or stop.wait(args.interval):
+                break
+    finally:
+        store.close()
+        write_log("Headless sync stopped.")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Все права защищены (c) 2024.
+Замеры горячих участков FTP-системы АТС: интервалы (span) и счетчики,
+сводки прогонов в JSON и текстовый файл в формате Prometheus.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import json
+import time
+import threading
+import functools
+
+from contextlib import contextmanager
+from datetime import datetime
+
+# Сколько последних сводок каждого вида хранится в папке
+SUMMARY_KEEP = 30
+PROM_PREFIX = "pbx"
+
+
+class Metrics:
+    """
+    Потокобезопасный реестр замеров. Для интервала хранятся число замеров,
+    суммарное, последнее и максимальное время в секундах, для счетчика — сумма.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = datetime.now()
+            self.spans = {}
+            self.counters = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self._lock:
+            entry = self.spans.get(name)
+            if entry is None:
+                entry = self.spans[name] = {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+            entry["count"] += 1
+            entry["total"] += seconds
+            entry["last"] = seconds
+            entry["max"] = max(entry["max"], seconds)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        Копия замеров: {"started", "finished", "spans": {...}, "counters": {...}}.
+        """
+        with self._lock:
+            return {
+                "started": self.started.isoformat(timespec="seconds"),
+                "finished": datetime.now().isoformat(timespec="seconds"),
+                "spans": {name: dict(entry) for name, entry in self.spans.items()},
+                "counters": dict(self.counters)
+            }
+
+
+metrics = Metrics()
+span = metrics.span
+incr = metrics.incr
+
+
+def timed(name):
+    """
+    Декоратор: каждый вызов функции замеряется как интервал name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_summary(directory, run_name, snapshot=None):
+    """
+    Сохраняет сводку прогона в directory/<run_name>-<время>.json;
+    старые сводки того же вида сверх SUMMARY_KEEP удаляются. Возвращает путь.
+    """
+    snapshot = snapshot or metrics.snapshot()
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(directory, f"{run_name}-{stamp}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(dict(snapshot, run=run_name), f, indent=4, ensure_ascii=False)
+
+    old = sorted(
+        name for name in os.listdir(directory)
+        if name.startswith(f"{run_name}-") and name.endswith(".json")
+    )
+    for name in old[:-SUMMARY_KEEP]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+    return path
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def prometheus_text(snapshot, job):
+    """
+    Замеры последнего прогона в текстовом формате Prometheus (все метрики — gauge).
+    """
+    lines = []
+    series = (
+        ("span_seconds_total", "Суммарное время интервала, с", "span", "total"),
+        ("span_seconds_max", "Максимальное время интервала, с", "span", "max"),
+        ("span_count", "Число замеров интервала", "span", "count"),
+    )
+    for metric, help_text, label, key in series:
+        lines.append(f"# HELP {PROM_PREFIX}_{metric} {help_text}")
+        lines.append(f"# TYPE {PROM_PREFIX}_{metric} gauge")
+        for name, entry in sorted(snapshot["spans"].items()):
+            lines.append(f'{PROM_PREFIX}_{metric}{{job="{_label(job)}",{label}="{_label(name)}"}} {entry[key]}')
+    lines.append(f"# HELP {PROM_PREFIX}_counter Значение счетчика")
+    lines.append(f"# TYPE {PROM_PREFIX}_counter gauge")
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append(f'{PROM_PREFIX}_counter{{job="{_label(job)}",name="{_label(name)}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(directory, job, snapshot=None):
+    """
+    Перезаписывает directory/<job>.prom (через временный файл, чтобы сборщик
+    не прочитал его наполовину). Возвращает путь.
+    """
+    snapshot = snapshot or metrics.snapshot()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{job}.prom")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(prometheus_text(snapshot, job))
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,120 @@
+"""
+Все права защищены (c) 2024.
+Папка Zvonki как кэш записей ограниченного размера: давно не слушанные
+записи удаляются, а при обращении скачиваются с FTP заново.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import time
+
+from datetime import datetime
+
+from common import write_log
+from ftp_download import fetch_file
+from ftp_session import FTPSession
+from sync_core import ZVONKI_DIR, parse_filename
+from recording_layout import recording_path, scan_recordings
+from perf_metrics import span, incr
+
+# Чистка освобождает место с запасом, чтобы не запускаться после каждого файла
+LOW_WATERMARK = 0.9
+# Сколько следующих строк таблицы подкачивается заранее при прослушивании
+PREFETCH_ROWS = 3
+
+
+def _call_timestamp(filename):
+    parsed = parse_filename(filename)
+    if parsed is None:
+        return None
+    try:
+        return datetime.strptime(f"{parsed['date']} {parsed['time']}", "%Y-%m-%d %H:%M:%S").timestamp()
+    except ValueError:
+        return None
+
+
+def enforce_budget(store, budget_bytes, target_dir=ZVONKI_DIR, keep=()):
+    """
+    Удаляет записи, пока папка не уменьшится до LOW_WATERMARK от бюджета.
+    Первыми уходят записи, которые дольше всех не слушали и не выгружали;
+    у нетронутых записей в расчет идет время самого звонка.
+    Метаданные и длительности в индексе остаются. Возвращает число удаленных файлов.
+    """
+    if budget_bytes <= 0 or not os.path.isdir(target_dir):
+        return 0
+    entries = [(name, path, size, mtime) for name, (path, size, mtime) in scan_recordings(target_dir).items()]
+    total = sum(size for _, _, size, _ in entries)
+    if total <= budget_bytes:
+        return 0
+
+    access = store.load_recording_access()
+    keep = set(keep)
+
+    def last_used(item):
+        name, _, _, mtime = item
+        return access.get(name) or _call_timestamp(name) or mtime
+
+    removed = []
+    target = budget_bytes * LOW_WATERMARK
+    for name, path, size, _ in sorted(entries, key=last_used):
+        if total <= target:
+            break
+        if name in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            write_log(f"Cache eviction of {name} failed: {e}")
+            continue
+        total -= size
+        removed.append(name)
+    # Вытесненные записи синхронизация не качает заново, в отличие от потерянных
+    store.mark_remote_only(removed)
+    incr("cache.evicted", len(removed))
+    write_log(f"Recording cache: evicted {len(removed)} files, {total // (1024 * 1024)} MB left.")
+    return len(removed)
+
+
+class RecordingCache:
+    """
+    Доступ к записи по имени файла: локальная копия или скачивание с FTP
+    в папку кэша через одну FTPSession. Методы fetch, keepalive и close
+    вызываются из одного (фонового) потока.
+    """
+    def __init__(self, store, host, user, passwd, target_dir=ZVONKI_DIR):
+        self.store = store
+        self.target_dir = target_dir
+        self.session = FTPSession(host, user, passwd)
+
+    def local_path(self, filename):
+        return recording_path(self.target_dir, filename)
+
+    def fetch(self, filename):
+        """
+        Путь к локальной копии записи; отсутствующая запись скачивается
+        из папки дня звонка и отмечается как использованная.
+        """
+        path = self.local_path(filename)
+        if os.path.exists(path):
+            return path
+        parsed = parse_filename(filename)
+        if parsed is None:
+            raise ValueError(f"unknown recording name: {filename}")
+        start = time.perf_counter()
+        with span("ftp.fetch"):
+            received = self.session.run(lambda ftp: fetch_file(ftp, filename, path), folder=parsed["date"])
+        incr("ftp.fetch_bytes", received)
+        self.store.add_download(filename, path)
+        # Полученная запись нужна сейчас: без отметки чистка сочла бы старый звонок давно не слушанным
+        self.store.touch_recordings([filename])
+        write_log("Recording fetched on demand", event="fetch", file=filename, bytes=received,
+                  duration_ms=round((time.perf_counter() - start) * 1000, 1))
+        return path
+
+    def keepalive(self):
+        self.session.keepalive()
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,85 @@
+"""
+Все права защищены (c) 2024.
+Раскладка записей на диске: Zvonki/YYYY/MM/DD/<файл>.mp3 вместо одной
+плоской папки, обход кэша одним проходом os.scandir и перенос старой раскладки.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import re
+
+from common import write_log
+
+# Дата звонка в имени записи: acc_in_2024_01_31-10_00_00_79000.mp3
+_DATE_IN_NAME = re.compile(r"_(\d{4})_(\d{2})_(\d{2})-")
+
+
+def day_dir(root, filename):
+    """
+    Папка дня для записи; запись с нераспознанным именем лежит в корне.
+    """
+    match = _DATE_IN_NAME.search(filename)
+    if match is None:
+        return root
+    return os.path.join(root, *match.groups())
+
+
+def recording_path(root, filename):
+    return os.path.join(day_dir(root, filename), filename)
+
+
+def _scan_dir(path, depth, found):
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            if entry.name.endswith(".mp3") and entry.is_file():
+                st = entry.stat()
+                found[entry.name] = (entry.path, st.st_size, st.st_mtime)
+            elif depth < 3 and entry.is_dir() and entry.name.isdigit():
+                _scan_dir(entry.path, depth + 1, found)
+
+
+def scan_recordings(root):
+    """
+    Все записи кэша за один обход: {имя файла: (путь, размер, mtime)}.
+    Читаются только папки YYYY/MM/DD и корень (нераспознанные имена и записи,
+    еще не перенесенные из старой раскладки).
+    """
+    found = {}
+    _scan_dir(root, 0, found)
+    return found
+
+
+def migrate_flat_layout(root):
+    """
+    Однократно раскладывает записи из корня root по папкам дней, вместе
+    с недокачанными .part. Возвращает [(имя файла, старый путь, новый путь)]
+    для перенесенных записей.
+    """
+    if not os.path.isdir(root):
+        return []
+    moved = []
+    with os.scandir(root) as it:
+        entries = [entry for entry in it if entry.is_file() and entry.name.endswith((".mp3", ".mp3.part"))]
+    created = set()
+    for entry in entries:
+        target_dir = day_dir(root, entry.name)
+        if target_dir == root:
+            continue
+        if target_dir not in created:
+            os.makedirs(target_dir, exist_ok=True)
+            created.add(target_dir)
+        new_path = os.path.join(target_dir, entry.name)
+        try:
+            os.replace(entry.path, new_path)
+        except OSError as e:
+            write_log(f"Moving {entry.name} to {target_dir} failed: {e}")
+            continue
+        if entry.name.endswith(".mp3"):
+            moved.append((entry.name, entry.path, new_path))
+    return moved
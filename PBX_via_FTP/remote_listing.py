@@ -0,0 +1,157 @@
+"""
+Все права защищены (c) 2024.
+Кэш листинга папок /recordings на FTP-сервере АТС.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import json
+
+from datetime import date, datetime
+from ftplib import error_perm
+
+from common import CONFIG_DIR, write_log
+
+LISTING_PATH = os.path.join(CONFIG_DIR, "remote_listing.json")
+
+
+def parse_mlsd_modify(value):
+    """
+    Переводит факт modify из MLSD (YYYYMMDDHHMMSS[.sss]) в ISO-строку.
+    """
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:14], "%Y%m%d%H%M%S").isoformat()
+    except ValueError:
+        return None
+
+
+def mlsd_unsupported(error):
+    """
+    Ответ сервера означает, что MLSD не реализована (500/502 или «command not understood»).
+    """
+    text = str(error)
+    return text[:3] in ("500", "502") or "not understood" in text.lower()
+
+
+class RemoteListing:
+    """
+    Кэш содержимого папок-дат на сервере: имена файлов, размеры и время изменения.
+    Папка прошлого дня, полностью скачанная после его окончания, помечается
+    как complete и при следующих синхронизациях больше не перечитывается.
+    С path=None кэш живет только в памяти (опрос текущего дня).
+    """
+    def __init__(self, path=LISTING_PATH):
+        self.path = path
+        self.folders = {}
+        self.mlsd_supported = True
+        self.load()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.folders = json.load(f).get("folders", {})
+        except (OSError, json.JSONDecodeError) as e:
+            write_log(f"Ошибка чтения кэша листинга: {e}")
+            self.folders = {}
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"folders": self.folders}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            write_log(f"Ошибка сохранения кэша листинга: {e}")
+
+    def is_complete(self, folder):
+        return self.folders.get(folder, {}).get("complete", False)
+
+    def needs_listing(self, folder):
+        """
+        Сегодняшняя, новая и незавершенная папки перечитываются, остальные берутся из кэша.
+        """
+        return folder not in self.folders or not self.is_complete(folder)
+
+    def files(self, folder):
+        """
+        Словарь {имя файла: {"size": int | None, "modify": str | None}}.
+        """
+        return self.folders.get(folder, {}).get("files", {})
+
+    def list_folder(self, ftp, folder):
+        """
+        Читает содержимое папки одним запросом (MLSD, а при его отсутствии NLST)
+        и обновляет кэш. Ошибка доступа к самой папке (550) пробрасывается.
+        """
+        path = f"/recordings/{folder}"
+        files = None
+        if self.mlsd_supported:
+            try:
+                files = {
+                    name: {"size": int(facts["size"]) if "size" in facts else None,
+                           "modify": parse_mlsd_modify(facts.get("modify"))}
+                    for name, facts in ftp.mlsd(path, facts=["type", "size", "modify"])
+                    if facts.get("type", "file") == "file" and name.endswith(".mp3")
+                }
+            except error_perm as e:
+                # 550 и прочие ответы о самой папке (например, ее еще нет) пробрасываются:
+                # на NLST переходим, только если сервер не знает команды MLSD
+                if not mlsd_unsupported(e):
+                    raise
+                write_log(f"MLSD не поддерживается сервером, используется NLST: {e}")
+                self.mlsd_supported = False
+        previous = self.folders.get(folder, {})
+        if files is None:
+            # NLST не знает размеров: сохраняем те, что уже были получены через SIZE
+            known = previous.get("files", {})
+            files = {}
+            for name in ftp.nlst(path):
+                name = os.path.basename(name)
+                if name.endswith(".mp3"):
+                    files[name] = known.get(name, {"size": None, "modify": None})
+
+        self.folders[folder] = {
+            "listed_at": date.today().isoformat(),
+            "complete": False,
+            "verified": previous.get("verified", False),
+            "files": files
+        }
+        return files
+
+    def mark_complete(self, folder):
+        """
+        Помечает папку завершенной, если ее листинг снят уже после окончания этого дня.
+        """
+        entry = self.folders.get(folder)
+        if entry and entry.get("listed_at", "") > folder:
+            entry["complete"] = True
+
+    def mark_incomplete(self, folder):
+        if folder in self.folders:
+            self.folders[folder]["complete"] = False
+
+    def is_verified(self, folder):
+        return self.folders.get(folder, {}).get("verified", False)
+
+    def mark_verified(self, folder):
+        """
+        Локальные копии файлов папки сверены с размерами на сервере.
+        """
+        if folder in self.folders:
+            self.folders[folder]["verified"] = True
+
+    def prune(self, keep_folders):
+        """
+        Убирает из кэша папки, вышедшие за период синхронизации.
+        """
+        keep = set(keep_folders)
+        for folder in [f for f in self.folders if f not in keep]:
+            del self.folders[folder]
@@ -0,0 +1,87 @@
+"""
+Все права защищены (c) 2024.
+Триграммный индекс для поиска подстроки в номерах, аккаунтах и именах сотрудников.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import re
+
+import numpy as np
+
+GRAM = 3
+
+
+def normalize_number(text):
+    """
+    Номер для поиска: только цифры.
+    """
+    return re.sub(r"\D", "", text)
+
+
+def normalize_text(text):
+    """
+    Аккаунт или имя для поиска: без регистра и лишних пробелов.
+    """
+    return " ".join(text.lower().split())
+
+
+class TrigramIndex:
+    """
+    Словарь различных значений (номеров, аккаунтов, имен) с обратным индексом
+    триграмм → множество идентификаторов значений. Идентификатор значения —
+    его позиция в self.values, поэтому он стабилен при добавлении новых значений.
+    """
+    def __init__(self, normalize=normalize_text):
+        self.normalize = normalize
+        self.values = []
+        self._keys = []
+        self._ids = {}
+        self._postings = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def id_for(self, value):
+        """
+        Идентификатор значения; новое значение сразу добавляется в индекс.
+        """
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = self._ids[value] = len(self.values)
+            self.values.append(value)
+            key = self.normalize(value)
+            self._keys.append(key)
+            for i in range(len(key) - GRAM + 1):
+                self._postings.setdefault(key[i:i + GRAM], set()).add(value_id)
+        return value_id
+
+    def search(self, query):
+        """
+        Идентификаторы значений, содержащих query как подстроку (после нормализации).
+        Кандидаты — пересечение списков триграмм запроса начиная с самого короткого,
+        затем подстрока проверяется только у кандидатов.
+        """
+        if not query.strip():
+            return np.arange(len(self.values), dtype=np.int32)
+        query = self.normalize(query)
+        if not query:
+            return np.empty(0, dtype=np.int32)
+
+        if len(query) < GRAM:
+            candidates = range(len(self.values))
+        else:
+            grams = {query[i:i + GRAM] for i in range(len(query) - GRAM + 1)}
+            postings = sorted((self._postings.get(g, set()) for g in grams), key=len)
+            if not postings[0]:
+                return np.empty(0, dtype=np.int32)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates &= posting
+                if not candidates:
+                    return np.empty(0, dtype=np.int32)
+            candidates = sorted(candidates)
+
+        keys = self._keys
+        return np.array([i for i in candidates if query in keys[i]], dtype=np.int32)
@@ -0,0 +1,610 @@
+"""
+Все права защищены (c) 2024.
+Синхронизация записей без GUI: скачивание с FTP, пересборка индекса звонков
+и определение длительностей. Используется потоками main.py и pbx_sync.py.
+Код предназначен исключительно для ознакомления.
+Любое распространение и/или модификация без согласия автора запрещены.
+"""
+
+
+import os
+import re
+import time
+
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from ftplib import error_perm
+
+from common import CONFIG_DIR, write_log
+from ftp_download import (
+    ParallelDownloader, RateLimiter, fetch_file, find_truncated_files, DEFAULT_WORKERS
+)
+from ftp_session import FTPSession, SessionLost
+from remote_listing import RemoteListing
+from recording_layout import recording_path, scan_recordings, migrate_flat_layout
+from call_store import build_call_index
+from perf_metrics import span, incr, timed
+from mp3_probe import probe_durations, PROBE_WORKERS, PROBE_CHUNK
+
+ZVONKI_DIR = os.path.join(CONFIG_DIR, "Zvonki")
+
+# Сколько последних дней скачивается в первую очередь, до догрузки старых
+PRIORITY_DAYS = 3
+
+# Записи АТС — mp3 с постоянным битрейтом 32 кбит/с: по размеру файла на сервере
+# длительность оценивается без скачивания
+RECORDING_BYTES_PER_SECOND = 32000 // 8
+
+# Первые минуты суток опрос продолжает следить и за вчерашней папкой
+MIDNIGHT_WINDOW = timedelta(hours=1)
+
+
+def _always_running():
+    return True
+
+
+def _ignore(*args):
+    pass
+
+
+def is_date_format(folder_name):
+    try:
+        datetime.strptime(folder_name, "%Y-%m-%d")
+        return True
+    except ValueError:
+        return False
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    h = seconds // 3600
+    m = (seconds % 3600) // 60
+    s = seconds % 60
+    return f"{h:02d}:{m:02d}:{s:02d}"
+
+
+def parse_filename(filename):
+    pattern = (r"(?P<account>[\w\d]+)_(?P<type>in|out)_(?P<date>\d{4}_\d{2}_\d{2})-"
+               r"(?P<time>\d{2}_\d{2}_\d{2})_(?P<number>[\d]+)")
+    match = re.match(pattern, filename)
+    if match:
+        data = match.groupdict()
+        data["date"] = data["date"].replace("_", "-")
+        data["time"] = data["time"].replace("_", ":")
+        data["number"] = re.sub(r"\D", "", data["number"])
+        return data
+    else:
+        return None
+
+
+def estimate_duration(size):
+    """
+    Оценка длительности записи в секундах по ее размеру; None, если размер неизвестен.
+    """
+    if not size:
+        return None
+    return size / RECORDING_BYTES_PER_SECOND
+
+
+@timed("sync.download")
+def download_recordings(config, store, host, user, passwd, days_to_download=360,
+                        is_running=_always_running, progress=_ignore, status=_ignore, publish=None,
+                        on_priority_done=_ignore):
+    """
+    Скачивает с FTP записи за последние days_to_download дней в ZVONKI_DIR,
+    начиная с самых свежих. Последние PRIORITY_DAYS дней качаются всеми
+    сессиями, более старые (догрузка) — половиной, чтобы не забирать весь канал;
+    внутри этих границ число сессий подстраивается по скорости и ошибкам,
+    а config["download_limit_kbps"] ограничивает общую скорость.
+    Без publish скачанные файлы сразу попадают в config["downloads"];
+    с publish config не изменяется, а файлы каждой докачанной папки
+    передаются в publish([(имя, путь)]) — так свежие дни публикуются первыми.
+    progress получает проценты, status — текст для пользователя.
+    on_priority_done() вызывается, когда последние PRIORITY_DAYS дней скачаны
+    и опубликованы и осталась только догрузка старых.
+    С config["metadata_only"] записи не скачиваются: звонки регистрируются
+    по листингу (с размером на сервере для оценки длительности), а сами
+    файлы берутся с FTP при прослушивании (recording_cache.py). Так же
+    регистрируются старые записи, не поместившиеся в config["cache_limit_mb"].
+    Возвращает число скачанных файлов или None, если FTP недоступен.
+    """
+    write_log("Starting download.")
+    session = FTPSession(host, user, passwd, is_running=is_running)
+
+    def list_root(ftp):
+        # Часть серверов отдает в NLST полные пути
+        return [os.path.basename(name.rstrip("/")) for name in ftp.nlst("/recordings")]
+
+    target_date = datetime.now() - timedelta(days=days_to_download)
+    try:
+        with span("ftp.list_root"):
+            folders = session.run(list_root)
+        status("Подключение к FTP выполнено.")
+        write_log("Connected to FTP.")
+    except SessionLost as e:
+        status(f"Ошибка подключения к FTP: {e}")
+        write_log(f"FTP connection error: {e}")
+        return None
+    except Exception as e:
+        status(f"Ошибка получения списка папок: {e}")
+        write_log(f"Error getting folder list: {e}")
+        session.close()
+        return None
+
+    # Фильтрация папок по дате, свежие впереди
+    folders_to_download = sorted(
+        (f for f in folders if is_date_format(f) and f >= target_date.strftime("%Y-%m-%d")),
+        reverse=True
+    )
+
+    os.makedirs(ZVONKI_DIR, exist_ok=True)
+
+    # Папки прошлых дней, уже скачанные полностью, берутся из кэша листинга
+    listing = RemoteListing()
+    listing.prune(folders_to_download)
+    total_files = 0
+    queue_items = []
+    pending = {}
+    for folder in folders_to_download:
+        if not is_running():
+            break
+        if listing.needs_listing(folder):
+            try:
+                with span("ftp.list_folder"):
+                    folder_files = session.run(lambda ftp: listing.list_folder(ftp, folder))
+            except Exception as e:
+                write_log(f"Error accessing folder {folder}: {e}")
+                continue
+        else:
+            folder_files = listing.files(folder)
+        total_files += len(folder_files)
+        pending[folder] = 0
+
+    # Что уже лежит в кэше, узнаем одним обходом папки, без проверки каждого файла
+    local_files = scan_recordings(ZVONKI_DIR)
+
+    # Однократная сверка уже скачанных файлов: усеченные докачиваются заново
+    broken = set()
+    try:
+        broken = {file for _, file in session.run(
+            lambda ftp: find_truncated_files(ftp, listing, pending, local_files)
+        )}
+    except Exception as e:
+        write_log(f"Error verifying local files: {e}")
+    session.close()
+
+    # Размеры на сервере нужны для оценки длительности записей, которых нет на диске
+    store.save_remote_sizes([
+        (file, info["size"])
+        for folder in pending
+        for file, info in listing.files(folder).items()
+        if info.get("size") is not None
+    ])
+
+    # Записи, вытесненные из кэша или зарегистрированные без загрузки, заново
+    # не качаются: они будут получены при прослушивании. Остальные записи,
+    # которых нет на диске (недокачанный .part, удаленный файл), качаются снова
+    remote_only = store.load_remote_only()
+    for folder in pending:
+        if listing.is_complete(folder):
+            continue
+        for file, info in listing.files(folder).items():
+            if (file not in remote_only or file in broken) and file not in local_files:
+                queue_items.append((folder, file, info.get("size")))
+                pending[folder] += 1
+    write_log(f"Listing done: {len(pending)} folders, {total_files} files, {len(queue_items)} to download.")
+
+    priority = set(folders_to_download[:PRIORITY_DAYS])
+    if config.get("metadata_only", False):
+        register_remote(config, store, queue_items, publish)
+        for folder in pending:
+            listing.mark_complete(folder)
+        listing.save()
+        status(f"Зарегистрировано {len(queue_items)} звонков без загрузки записей.")
+        write_log("Metadata-only sync finished.")
+        return 0
+
+    budget = config.get("cache_limit_mb", 0) * 1024 * 1024
+    if budget > 0:
+        cached = sum(size for _, size, _ in local_files.values())
+        queue_items, remote_items = split_by_budget(queue_items, priority, budget - cached)
+        if remote_items:
+            # Скачивать догрузку, чтобы тут же вытеснить ее из кэша, незачем
+            register_remote(config, store, remote_items, publish)
+            for folder, _, _ in remote_items:
+                pending[folder] -= 1
+            total_files -= len(remote_items)
+            write_log(f"Cache budget reached: {len(remote_items)} older recordings registered without download.")
+
+    workers = config.get("download_workers", DEFAULT_WORKERS)
+    stages = (
+        ([item for item in queue_items if item[0] in priority], workers),
+        ([item for item in queue_items if item[0] not in priority], max(1, workers // 2)),
+    )
+
+    # Ограничение скорости общее для обоих этапов
+    limiter = RateLimiter(config.get("download_limit_kbps", 0) * 1024)
+
+    files_downloaded = total_files - len(queue_items)
+    downloaded_now = 0
+    batches = {}
+    for stage, (items, stage_workers) in enumerate(stages):
+        if stage == 1:
+            # Свежие папки, где часть файлов не скачалась, публикуются до догрузки
+            for folder in [f for f in batches if f in priority]:
+                publish(batches.pop(folder))
+            on_priority_done()
+        if not items or not is_running():
+            continue
+        status(f"Загрузка {len(items)} файлов в {stage_workers} потоков...")
+        downloader = ParallelDownloader(host, user, passwd, ZVONKI_DIR,
+                                        workers=stage_workers, is_running=is_running, limiter=limiter)
+        with span("ftp.transfer"):
+            for folder, file, local_path, error in downloader.download(items):
+                if error is not None:
+                    write_log(f"File download error: {error}", event="download_error", file=f"{folder}/{file}")
+                    incr("ftp.errors")
+                    continue
+                pending[folder] -= 1
+                incr("ftp.files")
+                nbytes = os.path.getsize(local_path)
+                incr("ftp.bytes", nbytes)
+                store.add_download(file, local_path)
+                if publish is None:
+                    config["downloads"][file] = local_path
+                else:
+                    batches.setdefault(folder, []).append((file, local_path))
+                    if pending[folder] == 0:
+                        publish(batches.pop(folder))
+                write_log("Downloaded file", event="download", file=file, bytes=nbytes)
+                files_downloaded += 1
+                downloaded_now += 1
+                progress(int((files_downloaded / total_files) * 100))
+                status(f"Загружено {files_downloaded} из {total_files} файлов")
+
+    # Папки, где часть файлов не скачалась, публикуются в конце
+    for folder in list(batches):
+        publish(batches.pop(folder))
+
+    for folder, left in pending.items():
+        if left == 0:
+            listing.mark_complete(folder)
+    listing.save()
+
+    status("Загрузка завершена.")
+    write_log("Download finished.")
+    return downloaded_now
+
+
+def split_by_budget(items, priority, free_bytes):
+    """
+    Делит очередь [(папка, файл, размер)] на скачиваемое и регистрируемое без
+    загрузки. Последние дни (priority) качаются всегда, более старые — пока
+    хватает free_bytes; очередь уже идет от свежих дней к старым.
+    Возвращает (скачать, зарегистрировать).
+    """
+    download, remote = [], []
+    for item in items:
+        folder, _, size = item
+        if folder in priority or (not remote and (size or 0) <= free_bytes):
+            download.append(item)
+            free_bytes -= size or 0
+        else:
+            # Как только запись не поместилась, более старые тоже не качаются
+            remote.append(item)
+    return download, remote
+
+
+def register_remote(config, store, items, publish=None, target_dir=ZVONKI_DIR):
+    """
+    Регистрирует записи [(папка, файл, размер)] без скачивания: в загрузки
+    попадает будущий путь в кэше. Публикация — как в download_recordings, по папкам.
+    """
+    batches = {}
+    for folder, file, _ in items:
+        local_path = recording_path(target_dir, file)
+        store.add_download(file, local_path, remote_only=True)
+        if publish is None:
+            config["downloads"][file] = local_path
+        else:
+            batches.setdefault(folder, []).append((file, local_path))
+    for folder in sorted(batches, reverse=True):
+        publish(batches[folder])
+
+
+def make_calls(store, files, old_index=None):
+    """
+    Звонки по скачанным файлам [(имя файла, локальный путь)]: разбор имени,
+    длительность (из кэша или по заголовкам mp3; для записи, которой нет
+    на диске, — оценка по размеру с флагом estimated) и отметки. Отметки берутся
+    из old_index, если звонок в нем есть, иначе из БД.
+    Возвращает список (дата папки, звонок); folder_info не изменяется.
+    """
+    parsed_files = []
+    for filename, local_path in files:
+        parsed = parse_filename(filename)
+        if parsed:
+            parsed_files.append((filename, local_path, parsed))
+    if not parsed_files:
+        return []
+
+    # Длительности берутся из кэша, новые файлы разбираются параллельно
+    cache = store.load_duration_cache()
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+        durations, new_entries = probe_durations([p for _, p, _ in parsed_files], cache, executor)
+    if new_entries:
+        store.save_duration_cache(new_entries)
+    # Записей, которых нет на диске, длительность оценивается по размеру на сервере
+    remote_sizes = store.load_remote_sizes(f for f, p, _ in parsed_files if durations.get(p) is None)
+    old_index = old_index or {}
+    stored_marks = store.load_marks(f for f, _, _ in parsed_files if f not in old_index)
+
+    date_calls = []
+    for filename, local_path, parsed in parsed_files:
+        duration_seconds = durations.get(local_path)
+        estimated = duration_seconds is None
+        if estimated:
+            duration_seconds = estimate_duration(remote_sizes.get(filename))
+        if duration_seconds is not None:
+            duration_str = format_duration(duration_seconds)
+        else:
+            duration_str = "Неизвестно"
+
+        old_call = old_index.get(filename)
+        if old_call is not None:
+            marks = old_call.get("marks", {})
+        else:
+            marks = stored_marks.get(filename, {})
+
+        date_calls.append((parsed["date"], {
+            "filename": filename,
+            "type": "Входящий" if parsed["type"] == "in" else "Исходящий",
+            "number": re.sub(r"\D", "", parsed["number"]),
+            "account": parsed["account"],
+            "datetime": f"{parsed['date']} {parsed['time']}",
+            "duration": duration_str,
+            "estimated": estimated and duration_seconds is not None,
+            "marks": marks
+        }))
+    return date_calls
+
+
+def ingest_files(store, files):
+    """
+    Звонки по новым файлам сразу записываются в БД; возвращаются для index_calls.
+    """
+    date_calls = make_calls(store, files)
+    if date_calls:
+        store.add_calls(date_calls)
+    return date_calls
+
+
+def index_calls(folder_info, call_index, date_calls):
+    """
+    Добавляет звонки в folder_info (со счетчиками по дням) и в индекс по имени файла.
+    Звонки, которые уже есть в индексе, пропускаются. Возвращает добавленные.
+    """
+    added = []
+    for call_date_str, call_data in date_calls:
+        if call_data["filename"] in call_index:
+            continue
+        folder = folder_info.get(call_date_str)
+        if folder is None:
+            folder = folder_info[call_date_str] = {
+                "day": datetime.strptime(call_date_str, "%Y-%m-%d").strftime("%A"),
+                "incoming": 0,
+                "outgoing": 0,
+                "calls": []
+            }
+        if call_data["type"] == "Входящий":
+            folder["incoming"] += 1
+        else:
+            folder["outgoing"] += 1
+        folder["calls"].append(call_data)
+        call_index[call_data["filename"]] = call_data
+        added.append((call_date_str, call_data))
+    return added
+
+
+@timed("calls.rebuild")
+def rebuild_calls(config, store, full=False):
+    """
+    Пересборка folder_info по config["downloads"]. По умолчанию инкрементальная:
+    добавляются только файлы, которых еще нет в индексе звонков.
+    Возвращает список добавленных звонков (дата папки, звонок).
+    """
+    start = time.perf_counter()
+    call_index = config.get("call_index")
+    if call_index is None:
+        call_index = build_call_index(config.get("folder_info", {}))
+
+    if full:
+        # Полная пересборка: отметки переносятся через индекс по имени файла
+        old_index = call_index
+        folder_info = {}
+        call_index = {}
+    else:
+        old_index = {}
+        folder_info = config.setdefault("folder_info", {})
+
+    files = [(f, p) for f, p in config.get("downloads", {}).items() if f not in call_index]
+    added = index_calls(folder_info, call_index, make_calls(store, files, old_index))
+
+    if full:
+        config["folder_info"] = folder_info
+        store.replace_calls(folder_info)
+    elif added:
+        store.add_calls(added)
+    config["call_index"] = call_index
+    write_log(f"Rebuild finished: {len(added)} new calls.", event="rebuild",
+              duration_ms=round((time.perf_counter() - start) * 1000, 1))
+    return added
+
+
+def migrate_recording_layout(store, root=ZVONKI_DIR):
+    """
+    Однократный переход с плоской папки Zvonki на папки дней: файлы
+    переносятся, а пути в загрузках и кэше длительностей обновляются,
+    в том числе у записей, уже вытесненных из кэша. Возвращает число
+    перенесенных файлов. Вызывается до store.load_into.
+    """
+    moves = migrate_flat_layout(root)
+    moved_names = {filename for filename, _, _ in moves}
+    # Вытесненные записи: файла нет, но путь в загрузках еще старый
+    for filename, local_path in store.load_downloads().items():
+        if filename in moved_names or os.path.dirname(local_path) != root:
+            continue
+        new_path = recording_path(root, filename)
+        if new_path != local_path and not os.path.exists(local_path):
+            moves.append((filename, local_path, new_path))
+    if moves:
+        store.move_recordings(moves)
+        write_log(f"Recordings moved to per-day folders: {len(moved_names)} files, {len(moves)} paths updated.")
+    return len(moved_names)
+
+
+def recent_folders(now=None):
+    """
+    Папки, за которыми следит опрос: сегодняшняя, а в первый час суток
+    еще и вчерашняя, куда могут дописываться звонки, начатые до полуночи.
+    """
+    now = now or datetime.now()
+    folders = [now.strftime("%Y-%m-%d")]
+    if now - MIDNIGHT_WINDOW < now.replace(hour=0, minute=0, second=0, microsecond=0):
+        folders.insert(0, (now - timedelta(days=1)).strftime("%Y-%m-%d"))
+    return folders
+
+
+class RecentPoller:
+    """
+    Опрос папок последних дней на FTP в одной постоянной сессии (FTPSession).
+    Каждый вызов poll() скачивает только файлы, которых еще нет в known,
+    и возвращает готовые звонки (дата папки, звонок). Общие структуры
+    (folder_info, downloads) не изменяются: их обновляет вызывающий код
+    в своем потоке через index_calls. С metadata_only новые звонки только
+    регистрируются, а записи скачиваются при прослушивании.
+    """
+    def __init__(self, store, host, user, passwd, known, target_dir=ZVONKI_DIR, metadata_only=False):
+        self.store = store
+        self.metadata_only = metadata_only
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+        self.known = set(known)
+        self.target_dir = target_dir
+        self.listing = RemoteListing(path=None)
+        self.session = FTPSession(host, user, passwd)
+
+    def close(self):
+        self.session.close()
+
+    def keepalive(self):
+        self.session.keepalive()
+
+    @timed("ftp.poll")
+    def poll(self, is_running=_always_running):
+        """
+        Возвращает (новые файлы [(имя, путь)], новые звонки [(дата, звонок)]).
+        Обрыв соединения лечится переподключением внутри FTPSession;
+        файл, который так и не скачался, просто попадет в следующий опрос.
+        """
+        self.session.is_running = is_running
+        fetched = []
+        for folder in recent_folders():
+            if not is_running():
+                break
+            try:
+                folder_files = self.session.run(lambda ftp: self.listing.list_folder(ftp, folder))
+            except error_perm:
+                # Папка дня появляется на сервере с первым звонком
+                continue
+            except Exception as e:
+                write_log(f"Polling error: {e}")
+                break
+            for file, info in folder_files.items():
+                if file in self.known:
+                    continue
+                if not is_running():
+                    break
+                local_path = recording_path(self.target_dir, file)
+                if info.get("size") is not None:
+                    self.store.save_remote_sizes([(file, info["size"])])
+                if not self.metadata_only and not os.path.exists(local_path):
+                    try:
+                        self.session.run(
+                            lambda ftp: fetch_file(ftp, file, local_path, info.get("size")), folder=folder
+                        )
+                    except Exception as e:
+                        write_log(f"Polling: download of {file} failed: {e}")
+                        continue
+                self.store.add_download(file, local_path, remote_only=self.metadata_only)
+                self.known.add(file)
+                fetched.append((file, local_path))
+
+        date_calls = ingest_files(self.store, fetched)
+        if date_calls:
+            write_log(f"Polling: {len(date_calls)} new calls.")
+        return fetched, date_calls
+
+
+@timed("durations.load")
+def load_durations(config, store, is_running=_always_running, on_batch=_ignore, only=None):
+    """
+    Определяет точную длительность звонков, у которых она неизвестна или
+    оценена по размеру файла. only — имена файлов, которыми ограничить обход
+    (например, только что скачанная запись). Файлы обрабатываются пачками:
+    одна запись в БД и один вызов on_batch на пачку.
+    Возвращает число обновленных звонков.
+    """
+    if only is not None:
+        call_index = config.get("call_index", {})
+        calls = [call_index[f] for f in only if f in call_index]
+        local_files = {}
+        for filename in only:
+            local_path = config["downloads"].get(filename)
+            if local_path and os.path.exists(local_path):
+                local_files[filename] = (local_path,)
+    else:
+        # Снимки списков: GUI может добавлять звонки, пока идет обход
+        calls = [
+            call
+            for folder_data in list(config.get("folder_info", {}).values())
+            for call in list(folder_data.get("calls", []))
+        ]
+        local_files = scan_recordings(ZVONKI_DIR)
+    pending = []
+    for call in calls:
+        if call.get("estimated") or call["duration"] in ("Неизвестно", "Ошибка"):
+            local = local_files.get(call["filename"])
+            if local is not None:
+                pending.append((call, local[0]))
+    if not pending:
+        return 0
+
+    updated = 0
+    cache = store.load_duration_cache()
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+        for i in range(0, len(pending), PROBE_CHUNK):
+            if not is_running():
+                break
+            chunk = pending[i:i + PROBE_CHUNK]
+            start = time.perf_counter()
+            durations, new_entries = probe_durations([p for _, p in chunk], cache, executor)
+            changed = []
+            for call, local_path in chunk:
+                duration_seconds = durations.get(local_path)
+                if duration_seconds is None:
+                    continue
+                call["duration"] = format_duration(duration_seconds)
+                call["estimated"] = False
+                changed.append((call["filename"], call["duration"]))
+            if new_entries:
+                store.save_duration_cache(new_entries)
+            if changed:
+                store.update_durations(changed)
+                updated += len(changed)
+                incr("durations.updated", len(changed))
+                on_batch()
+            write_log(f"Durations updated: {len(changed)} of {len(chunk)} calls in batch.", event="durations",
+                      duration_ms=round((time.perf_counter() - start) * 1000, 1))
+    return updated